@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#
+# bcd.py
+#
+# Packed BCD encode/decode for the CAT command sets
+#
+# Copyright (C) 2015 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+
+Frequencies are sent as packed BCD, two decimal digits per byte with the
+more significant digit in the high nibble.
+
+	Big endian		-	FT-817, most significant byte first
+						14.23456 MHz in 10 Hz units = 01 42 34 56
+	Little endian	-	CI-V, least significant byte first
+						14.230000 MHz in Hz = 00 00 23 14 00
+
+Encoding goes through a 100 entry value->byte table and decoding through
+a 256 entry byte->value table that also marks the bytes that are not BCD.
+
+"""
+
+import traceback
+
+# Byte -> value 0-99, -1 if the byte is not valid BCD
+BCD_TO_INT = tuple(((b >> 4) * 10 + (b & 0x0F)) if (b >> 4) < 10 and (b & 0x0F) < 10 else -1 for b in range(256))
+# Value 0-99 -> byte
+INT_TO_BCD = bytes(((i // 10) << 4) | (i % 10) for i in range(100))
+
+# Divisors for each byte of an n byte value, least significant first
+_POWERS = tuple(tuple(100 ** i for i in range(n)) for n in range(11))
+
+def encode_le(value, n):
+	"""
+	Return value as n bytes of little endian BCD
+
+	Arguments:
+		value	--	integer 0 to 100**n - 1
+		n		--	number of bytes
+
+	"""
+
+	if value < 0 or value >= 100 ** n:
+		raise ValueError('Value %d does not fit in %d BCD bytes' % (value, n))
+	return bytes([INT_TO_BCD[value // p % 100] for p in _POWERS[n]])
+
+def encode_be(value, n):
+	"""
+	Return value as n bytes of big endian BCD
+
+	Arguments:
+		value	--	integer 0 to 100**n - 1
+		n		--	number of bytes
+
+	"""
+
+	if value < 0 or value >= 100 ** n:
+		raise ValueError('Value %d does not fit in %d BCD bytes' % (value, n))
+	return bytes([INT_TO_BCD[value // p % 100] for p in reversed(_POWERS[n])])
+
+def decode_le(data, offset, n):
+	"""
+	Return the value of n bytes of little endian BCD
+
+	Arguments:
+		data	--	bytes, bytearray or memoryview
+		offset	--	index of the least significant byte
+		n		--	number of bytes
+
+	Raises ValueError if the data is not valid BCD.
+
+	"""
+
+	value = 0
+	for b in reversed(data[offset:offset + n]):
+		pair = BCD_TO_INT[b]
+		if pair < 0:
+			raise ValueError('Data is not valid BCD')
+		value = value * 100 + pair
+	return value
+
+def decode_be(data, offset, n):
+	"""
+	Return the value of n bytes of big endian BCD
+
+	Arguments:
+		data	--	bytes, bytearray or memoryview
+		offset	--	index of the most significant byte
+		n		--	number of bytes
+
+	Raises ValueError if the data is not valid BCD.
+
+	"""
+
+	value = 0
+	for b in data[offset:offset + n]:
+		pair = BCD_TO_INT[b]
+		if pair < 0:
+			raise ValueError('Data is not valid BCD')
+		value = value * 100 + pair
+	return value
+
+# ============================================================================
+# Batch versions for scans and log analysis. These need numpy which is only
+# imported when one of them is used.
+
+def encode_le_array(values, n):
+	"""
+	Return an array of shape (len(values), n) of little endian BCD bytes
+
+	Arguments:
+		values	--	array like of integers 0 to 100**n - 1
+		n		--	number of bytes per value
+
+	"""
+
+	import numpy as np
+
+	values = np.asarray(values, dtype=np.int64)
+	if values.size > 0 and (values.min() < 0 or values.max() >= 100 ** n):
+		raise ValueError('Values do not fit in %d BCD bytes' % n)
+	table = np.frombuffer(INT_TO_BCD, dtype=np.uint8)
+	powers = np.array(_POWERS[n], dtype=np.int64)
+	return table[(values[:, None] // powers) % 100]
+
+def encode_be_array(values, n):
+	"""
+	Return an array of shape (len(values), n) of big endian BCD bytes
+
+	Arguments:
+		values	--	array like of integers 0 to 100**n - 1
+		n		--	number of bytes per value
+
+	"""
+
+	return encode_le_array(values, n)[:, ::-1]
+
+def decode_le_array(records):
+	"""
+	Return an int64 array of the values of little endian BCD records
+
+	Arguments:
+		records	--	uint8 array of shape (count, n), one value per row
+
+	Raises ValueError if any byte is not valid BCD.
+
+	"""
+
+	import numpy as np
+
+	table = np.array(BCD_TO_INT, dtype=np.int64)
+	pairs = table[records]
+	if pairs.size > 0 and pairs.min() < 0:
+		raise ValueError('Data is not valid BCD')
+	powers = np.array(_POWERS[records.shape[1]], dtype=np.int64)
+	return pairs @ powers
+
+def decode_be_array(records):
+	"""
+	Return an int64 array of the values of big endian BCD records
+
+	Arguments:
+		records	--	uint8 array of shape (count, n), one value per row
+
+	Raises ValueError if any byte is not valid BCD.
+
+	"""
+
+	return decode_le_array(records[:, ::-1])
+
+#======================================================================================================================
+# Entry point
+
+def main():
+
+	try:
+		ok = True
+		# Known vectors, the FT-817 frequency in 10 Hz units and the CI-V frequency in Hz
+		# with the 1 Hz and 10 Hz digits in the first byte
+		vectors = (
+			(encode_be, decode_be, 1423456, 4, bytes.fromhex('01423456')),
+			(encode_le, decode_le, 14230000, 5, bytes.fromhex('0000231400')),
+			(encode_le, decode_le, 14234567, 5, bytes.fromhex('6745231400')),
+		)
+		for encode, decode, value, n, data in vectors:
+			if encode(value, n) != data or decode(data, 0, n) != value:
+				print('Vector failed: %s %d %s' % (encode.__name__, value, data.hex()))
+				ok = False
+			# At an offset in a frame and through a memoryview
+			frame = memoryview(bytearray(b'\xfe\xfe' + data + b'\xfd'))
+			if decode(frame, 2, n) != value:
+				print('Vector failed at offset: %s %d' % (decode.__name__, value))
+				ok = False
+
+		# Round trip across each byte count, including the ends of the range
+		for n in range(1, 6):
+			for value in (0, 1, 9, 10, 99, 100, 100 ** n // 3, 100 ** n - 1):
+				if value >= 100 ** n:
+					continue
+				if decode_le(encode_le(value, n), 0, n) != value or decode_be(encode_be(value, n), 0, n) != value:
+					print('Round trip failed: %d in %d bytes' % (value, n))
+					ok = False
+
+		# Out of range values and bytes that are not BCD
+		for encode in (encode_le, encode_be):
+			for value in (-1, 10000):
+				try:
+					encode(value, 2)
+					print('Not rejected: %s %d' % (encode.__name__, value))
+					ok = False
+				except ValueError:
+					pass
+		for decode in (decode_le, decode_be):
+			for data in (b'\x1a\x00', b'\x00\xa0', b'\xff\xff'):
+				try:
+					decode(data, 0, 2)
+					print('Not rejected: %s %s' % (decode.__name__, data.hex()))
+					ok = False
+				except ValueError:
+					pass
+
+		# The batch versions must agree with the scalar ones
+		try:
+			import numpy as np
+		except ImportError:
+			np = None
+			print('numpy not installed, batch versions not tested')
+		if np != None:
+			n = 5
+			values = [0, 1, 14230000, 14234567, 100 ** n - 1] + list(range(3500000, 3500000 + 1000 * 37, 37))
+			le = encode_le_array(values, n)
+			be = encode_be_array(values, n)
+			for i, value in enumerate(values):
+				if bytes(le[i]) != encode_le(value, n) or bytes(be[i]) != encode_be(value, n):
+					print('Batch encode differs: %d' % value)
+					ok = False
+			if list(decode_le_array(le)) != values or list(decode_be_array(be)) != values:
+				print('Batch decode differs')
+				ok = False
+			for decode, records in ((decode_le_array, le.copy()), (decode_be_array, be.copy())):
+				records[1, 2] = 0x1A
+				try:
+					decode(records)
+					print('Not rejected: %s' % decode.__name__)
+					ok = False
+				except ValueError:
+					pass
+
+		print('BCD tests %s' % ('passed' if ok else 'FAILED'))
+	except Exception as e:
+		print ('Exception','Exception [%s][%s]' % (str(e), traceback.format_exc()))
+
+if __name__ == '__main__':
+	main()
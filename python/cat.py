@@ -26,15 +26,20 @@
 # System imports 
 import os,sys
 import socket
-import serial
-import glob
+import select
 import threading
-from time import sleep
+import heapq
+from time import sleep, monotonic
 import traceback
-from collections import deque
+from collections import deque, OrderedDict
+from types import MappingProxyType
+from concurrent.futures import Future
 
 # Application imports
 from commondefs import *
+from civ import *
+from serports import SERIAL_PORTS
+import bcd
 
 """
 
@@ -54,6 +59,59 @@ To define a new protocol:
 	3. Implement a new class for the variant modelled on FT817 class.
 """
 
+# Frequency set frames held by each variant
+FRAME_CACHE_SIZE = 64
+
+# Receive buffer size, holds any response frame
+RX_SIZE = 256
+
+# UDP requests in flight, per attempt timeout and resends
+UDP_WINDOW = 4
+UDP_TIMEOUT = 0.5
+UDP_RETRIES = 2
+
+# Latency histograms, bucket n counts latencies under 2**n microseconds
+HIST_BUCKETS = 24
+# Default interval for the stats callback
+STATS_INTERVAL = 10.0
+
+# Scheduled PTT, the thread wakes this early and spins for the last SPIN
+# seconds. Other traffic is held off if an exchange could still be running
+# PTT_GUARD seconds after its wire time when the PTT is due.
+PTT_WAKE = 0.01
+PTT_SPIN = 0.002
+PTT_GUARD = 0.02
+
+# Most frames gathered into one serial write
+WRITE_BATCH = 8
+
+# Seconds a frequency or mode read from the radio answers gets, 0 to always ask
+STATE_TTL = 0.5
+# Hz a frequency set may be from the radio's frequency and still be skipped
+FREQ_TOLERANCE = 0
+
+# Poll intervals, fast while the radio is changing and backing off to slow when not
+POLL_FAST = 0.1
+POLL_SLOW = 5.0
+POLL_BACKOFF = 2.0
+
+# Command priority classes, a lower class always goes first
+PRIORITY_SAFETY = 0
+PRIORITY_CONTROL = 1
+PRIORITY_QUERY = 2
+CAT_PRIORITY = {
+	CAT_PTT: PRIORITY_SAFETY,
+	CAT_LOCK: PRIORITY_SAFETY,
+	CAT_FREQ_SET: PRIORITY_CONTROL,
+	CAT_MODE_SET: PRIORITY_CONTROL,
+	CAT_FREQ_GET: PRIORITY_QUERY,
+	CAT_MODE_GET: PRIORITY_QUERY,
+	CAT_FREQ_MODE_GET: PRIORITY_QUERY,
+}
+
+# Gets answered by CAT_FREQ_MODE_GET and their index in its (Hz, mode) response
+FREQ_MODE_PARTS = {CAT_FREQ_GET: 0, CAT_MODE_GET: 1, CAT_FREQ_MODE_GET: None}
+
 """
 
 CAT class for all CAT variants.
@@ -94,32 +152,38 @@ class CAT:
 		
 		# Instance vars
 		self.__port_open = False
-		self.__ports = []
 		self.__device = None
 		self.__device = None
 		self.__cat_thrd = None
 		self.__callback = None
-		
-		# List the serial ports as we can't do this after we open.
-		self.__ports = self.__list_serial_ports()
+		self.__subscribers = []
+		self.__stats_callback = None
+		self.__stats_interval = STATS_INTERVAL
+		self.__recorder = None
+		self.__state_ttl = STATE_TTL
+		self.__freq_tolerance = FREQ_TOLERANCE
+		self.__polling = None
 		
 		# Setup transport dependent
 		if self.__transport == CAT_UDP and self.__ip != None:
 			# UDP transport			
-			# Create the UDP socket
+			# Create the UDP socket, timeouts are per request, see CATThrd
 			self.__device = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-			self.__device.settimeout(3)
+			self.__device.setblocking(False)
 		elif self.__transport == CAT_SERIAL and self.__com != None:
 			# Serial transport
+			# Start listing the serial ports in the background
+			SERIAL_PORTS.refresh()
 			# Open the serial port
 			try:
-				# Comment
-				self.__device = serial.Serial(port=self.__com, baudrate=self.__baud, parity=self.__command_set[SERIAL][PARITY], stopbits=self.__command_set[SERIAL][STOP_BITS], timeout=self.__command_set[SERIAL][TIMEOUT])
+				self.__device = self.__open_serial()
 				self.__port_open = True
 				print('Opened COM port for CAT %s' % (self.__com))
-			except (OSError, serial.SerialException):
+			except ImportError:
+				print('Failed to open COM port %s for CAT! pyserial is not installed' % (self.__com))
+			except OSError:
 				# Failed to open the port, radio device probably off
-				print('Failed to open COM port %s for CAT! Available ports are %s' % (self.__com, self.__list_serial_ports()))
+				print('Failed to open COM port %s for CAT! Available ports are %s' % (self.__com, SERIAL_PORTS.get(wait=True)))
 				pass
 		
 		if (self.__transport == CAT_SERIAL and self.__port_open) or self.__transport == CAT_UDP:	
@@ -135,11 +199,9 @@ class CAT:
 		else:
 			# Try to open the serial port again
 			try:
-				# List the serial ports again as we can't do this after we open.
-				self.__ports = self.__list_serial_ports()
-				self.__device = serial.Serial(port=self.__com, baudrate=self.__baud, parity=self.__command_set[SERIAL][PARITY], stopbits=self.__command_set[SERIAL][STOP_BITS], timeout=self.__command_set[SERIAL][TIMEOUT])
+				self.__device = self.__open_serial()
 				self.__port_open = True
-			except (OSError, serial.SerialException):
+			except (OSError, ImportError):
 				# Failed to open the port, radio device probably still off
 				return False
 			if self.__port_open:	
@@ -147,6 +209,12 @@ class CAT:
 				self.__cat_thrd = CATThrd(self.__variant, self.__command_set, self.__ip, self.__port, self.__transport, self.__device)
 				self.__cat_thrd.start()
 				if self.__callback != None: self.__cat_thrd.set_callback(self.__callback)
+				for subscriber in self.__subscribers: self.__cat_thrd.subscribe(subscriber)
+				if self.__stats_callback != None: self.__cat_thrd.set_stats_callback(self.__stats_callback, self.__stats_interval)
+				if self.__recorder != None: self.__cat_thrd.set_recorder(self.__recorder)
+				self.__cat_thrd.set_state_ttl(self.__state_ttl)
+				self.__cat_thrd.set_freq_tolerance(self.__freq_tolerance)
+				if self.__polling != None: self.__cat_thrd.set_polling(*self.__polling)
 			return True
 		
 	def set_callback(self, callback):
@@ -161,6 +229,165 @@ class CAT:
 		self.__callback = callback
 		if self.__cat_thrd != None:
 			self.__cat_thrd.set_callback(callback)
+	
+	def set_stats_callback(self, callback, interval = STATS_INTERVAL):
+		"""
+		Callback here with a stats() snapshot every interval seconds
+		
+		Arguments:
+			callback	--	the callable, None to stop
+			interval	--	seconds between calls
+			
+		"""
+		
+		self.__stats_callback = callback
+		self.__stats_interval = interval
+		if self.__cat_thrd != None:
+			self.__cat_thrd.set_stats_callback(callback, interval)
+	
+	def set_recorder(self, recorder):
+		"""
+		Record all wire traffic
+		
+		Arguments:
+			recorder	--	a catlog.CATRecorder, None to stop
+		
+		The caller owns the recorder and closes it after terminate().
+			
+		"""
+		
+		self.__recorder = recorder
+		if self.__cat_thrd != None:
+			self.__cat_thrd.set_recorder(recorder)
+	
+	def stats(self):
+		"""
+		Return counters and latencies for each command type
+		
+		See CATStats.snapshot() for the structure, None if there is no link.
+		
+		"""
+		
+		if self.__cat_thrd == None:
+			return None
+		return self.__cat_thrd.stats()
+	
+	def set_state_ttl(self, ttl):
+		"""
+		Change how long a known frequency and mode answer gets and make sets redundant
+		
+		Arguments:
+			ttl	--	seconds, 0 to send every get and set to the radio
+		
+		"""
+		
+		self.__state_ttl = ttl
+		if self.__cat_thrd != None:
+			self.__cat_thrd.set_state_ttl(ttl)
+	
+	def set_freq_tolerance(self, tolerance):
+		"""
+		Change how close a frequency set must be to the radio to be skipped
+		
+		Arguments:
+			tolerance	--	Hz, 0 to skip only a set to the frequency the radio is on
+		
+		"""
+		
+		self.__freq_tolerance = tolerance
+		if self.__cat_thrd != None:
+			self.__cat_thrd.set_freq_tolerance(tolerance)
+	
+	def state(self):
+		"""
+		Return what is known of the radio
+		
+		Returns {'freq': (Hz, age), 'mode': (mode, age), 'ptt': (state, age),
+		'lock': (state, age)}, ages are in seconds and None where the value
+		is not known, None if there is no link.
+		
+		"""
+		
+		if self.__cat_thrd == None:
+			return None
+		return self.__cat_thrd.state()
+	
+	def refresh(self, cat_cmd = CAT_FREQ_GET):
+		"""
+		Read the radio, bypassing the rig state
+		
+		Arguments:
+			cat_cmd	--	CAT_FREQ_GET | CAT_MODE_GET | CAT_FREQ_MODE_GET
+		
+		Returns a Future as do_command(). The answer updates the rig state.
+		
+		"""
+		
+		if (self.__transport == CAT_SERIAL and self.__port_open) or self.__transport == CAT_UDP:
+			return self.__cat_thrd.do_command(cat_cmd, None, True)
+		future = Future()
+		future.set_result((False, 'NOT OPEN'))
+		return future
+	
+	def start_polling(self, fast = POLL_FAST, slow = POLL_SLOW):
+		"""
+		Track the radio by reading the frequency and mode in the background
+		
+		Arguments:
+			fast	--	seconds between reads while the radio is changing
+			slow	--	most seconds between reads while it is not
+		
+		Each read that finds the frequency or mode changed goes back to the
+		fast interval, each that finds them the same doubles the interval up
+		to slow. Changes go to subscribers and the reads keep the rig state
+		fresh. Reads are queued as gets so they wait for any other command
+		and answer gets that are pending, their responses are not passed to
+		the callback.
+		
+		"""
+		
+		self.__polling = (fast, slow)
+		if self.__cat_thrd != None:
+			self.__cat_thrd.set_polling(fast, slow)
+	
+	def stop_polling(self):
+		""" Stop the background reads """
+		
+		self.__polling = None
+		if self.__cat_thrd != None:
+			self.__cat_thrd.set_polling(None, None)
+	
+	def subscribe(self, callback):
+		"""
+		Listen for frequency and mode changes
+		
+		Arguments:
+			callback	--	the callable, called with (CAT_EVT_FREQ, Hz) or (CAT_EVT_MODE, mode)
+		
+		The ICOM variant reports changes when CI-V Transceive is turned on in
+		the radio, on a serial link or through a network bridge. Otherwise use
+		start_polling() to find them.
+			
+		"""
+		
+		if callback not in self.__subscribers:
+			self.__subscribers.append(callback)
+		if self.__cat_thrd != None:
+			self.__cat_thrd.subscribe(callback)
+	
+	def unsubscribe(self, callback):
+		"""
+		Stop listening for changes
+		
+		Arguments:
+			callback	--	a callable given to subscribe()
+			
+		"""
+		
+		if callback in self.__subscribers:
+			self.__subscribers.remove(callback)
+		if self.__cat_thrd != None:
+			self.__cat_thrd.unsubscribe(callback)
 		
 	def terminate(self):
 		""" Ask the thread to terminate and wait for it to exit """
@@ -173,188 +400,1860 @@ class CAT:
 		if self.__device != None:
 			self.__device.close()
 
-	def do_command(self, cat_cmd, params = None):
+	def do_command(self, cat_cmd, params = None, force = False):
 		"""
 		Execute a new CAT command
 		
 		Arguments:
-			cat_cmd	-- 	from the CAT command enumerations
-			params	--	required parameters for the command
+			cat_cmd	-- 	from the CAT command enumerations
+			params	--	required parameters for the command
+			force	--	True to always send the command to the radio
+		
+		Returns a Future that resolves with the response tuple.
+		
+		A get is answered at once, and the callback made on the calling
+		thread, when the frequency and mode it asks for were learnt within
+		the state TTL, see set_state_ttl() and refresh(). A frequency or
+		mode set to what the radio confirmed it is on within the state TTL
+		is answered at once with (True, None) in the same way, see
+		set_freq_tolerance().
+		
+		"""
+		
+		if (self.__transport == CAT_SERIAL and self.__port_open) or self.__transport == CAT_UDP:
+			return self.__cat_thrd.do_command(cat_cmd, params, force)
+		future = Future()
+		future.set_result((False, 'NOT OPEN'))
+		return future
+	
+	def schedule_ptt(self, at, state = True):
+		"""
+		Switch PTT at a given time
+		
+		Arguments:
+			at		--	time.monotonic() value to switch at
+			state	--	True for transmit
+		
+		Returns a Future that resolves with the response tuple.
+		
+		For WSPR the transmitter must key one second into an even minute.
+		The frame is formatted now and written at the deadline, ahead of
+		anything queued, and other commands are held back so the line is
+		free. How far from the deadline each write was is in stats().
+		
+		"""
+		
+		if (self.__transport == CAT_SERIAL and self.__port_open) or self.__transport == CAT_UDP:
+			return self.__cat_thrd.schedule_ptt(at, state)
+		future = Future()
+		future.set_result((False, 'NOT OPEN'))
+		return future
+	
+	def get_serial_ports(self):
+		""" Return available serial port names """
+		
+		return SERIAL_PORTS.get()
+	
+	def __open_serial(self):
+		"""
+		Open the serial port
+		
+		pyserial is only imported here so UDP only installations don't need it.
+		Raises ImportError if it is missing and OSError (SerialException) if
+		the port can't be opened.
+		
+		"""
+		
+		import serial
+		
+		return serial.Serial(port=self.__com, baudrate=self.__baud, parity=self.__command_set[SERIAL][PARITY], stopbits=self.__command_set[SERIAL][STOP_BITS], timeout=self.__command_set[SERIAL][TIMEOUT])
+	
+"""
+
+Command queue for the CAT thread.
+
+"""
+class CATQueue:
+	
+	"""
+	Commands are held in three priority classes, see CAT_PRIORITY.
+	
+		safety		--	PTT and lock
+		control		--	frequency and mode sets
+		query		--	gets
+	
+	The next command is the oldest in the highest class that has one, so a
+	PTT never waits behind frequency traffic. Commands keep arrival order
+	within a class.
+	
+	A frequency set is coalesced into any frequency set that is still
+	pending so only the latest frequency goes to the radio. Duplicate gets
+	are likewise merged into the one already pending. PTT, lock and mode
+	commands are never coalesced or dropped.
+	
+	Each entry is [cat_cmd, params, [futures], queued] where queued is the
+	monotonic time the entry was added. A coalesced command adds its Future
+	to the pending entry so all callers receive the one response.
+	
+	This class is not thread safe, the caller must hold the lock.
+	
+	"""
+	
+	# Commands where only the latest is of interest
+	COALESCE = (CAT_FREQ_SET, CAT_FREQ_GET, CAT_MODE_GET, CAT_FREQ_MODE_GET)
+	
+	def __init__(self):
+		"""
+		Constructor
+		
+		"""
+		
+		# One deque per priority class
+		self.__q = (deque(), deque(), deque())
+		# Coalescable command -> pending entry
+		self.__pending = {}
+	
+	def __len__(self):
+		
+		return len(self.__q[PRIORITY_SAFETY]) + len(self.__q[PRIORITY_CONTROL]) + len(self.__q[PRIORITY_QUERY])
+		
+	def put(self, cat_cmd, params, future):
+		"""
+		Add a command
+		
+		Arguments:
+			cat_cmd	-- 	from the CAT command enumerations
+			params	--	required parameters for the command
+			future	--	Future to resolve with the response
+		
+		Returns True if the command was coalesced into a pending command.
+			
+		"""
+		
+		if cat_cmd in self.__pending:
+			entry = self.__pending[cat_cmd]
+			entry[1] = params
+			entry[2].append(future)
+			return True
+		entry = [cat_cmd, params, [future], monotonic()]
+		self.__q[CAT_PRIORITY.get(cat_cmd, PRIORITY_CONTROL)].append(entry)
+		if cat_cmd in self.COALESCE:
+			self.__pending[cat_cmd] = entry
+		return False
+	
+	def get(self):
+		"""
+		Return the next entry or None if empty
+		
+		"""
+		
+		for q in self.__q:
+			if len(q) > 0:
+				entry = q.popleft()
+				if self.__pending.get(entry[0]) is entry:
+					del self.__pending[entry[0]]
+				return entry
+		return None
+	
+	def requeue(self, entry):
+		"""
+		Put an entry that was interrupted back at the head of its class
+		
+		Arguments:
+			entry	--	as returned by get()
+			
+		"""
+		
+		cat_cmd = entry[0]
+		pending = self.__pending.get(cat_cmd)
+		if pending != None:
+			# The same command arrived since, one exchange answers both
+			pending[2][:0] = entry[2]
+			pending[3] = min(pending[3], entry[3])
+			return
+		self.__q[CAT_PRIORITY.get(cat_cmd, PRIORITY_CONTROL)].appendleft(entry)
+		if cat_cmd in self.COALESCE:
+			self.__pending[cat_cmd] = entry
+	
+	def take(self, cat_cmd):
+		"""
+		Remove and return the pending entry for a coalesced command or None
+		
+		Arguments:
+			cat_cmd	-- 	one of CATQueue.COALESCE
+			
+		"""
+		
+		entry = self.__pending.pop(cat_cmd, None)
+		if entry != None:
+			self.__q[CAT_PRIORITY.get(cat_cmd, PRIORITY_CONTROL)].remove(entry)
+		return entry
+	
+	def priority(self):
+		""" Return the class of the next entry or None if empty """
+		
+		for priority, q in enumerate(self.__q):
+			if len(q) > 0:
+				return priority
+		return None
+	
+	def waiting_above(self, priority):
+		"""
+		True if anything of a higher class than priority is queued
+		
+		Arguments:
+			priority	--	a priority class
+			
+		"""
+		
+		for q in self.__q[:priority]:
+			if len(q) > 0:
+				return True
+		return False
+	
+"""
+
+Command statistics for the CAT thread.
+
+"""
+class CATStats:
+	
+	"""
+	Counters and latency histograms for each command type.
+	
+	Each command is timed when it is queued by do_command(), taken by the
+	thread, written and answered, giving the stages:
+		queue		--	queued to taken
+		send		--	taken to written, formatting and pacing
+		response	--	written to answered, including any resends
+		total		--	queued to answered
+	
+	A stage keeps a count, sum, maximum and a histogram with power of two
+	microsecond buckets, so recording is a few integer operations and the
+	stats can be left on. Merged freq and mode gets are timed as the one
+	CAT_FREQ_MODE_GET exchange and counted as coalesced under their own type.
+	Sets that shared a serial write are counted as batched and all take the
+	time the first was taken. Gets answered from the rig state and sets that
+	would leave the radio as it is never reach the thread and are only
+	counted as cached and suppressed.
+	
+	"""
+	
+	STAGES = ('queue', 'send', 'response', 'total')
+	COUNTERS = ('count', 'ok', 'timeouts', 'naks', 'errors', 'coalesced', 'dropped', 'resends', 'preempted', 'batched', 'cached', 'suppressed')
+	
+	def __init__(self):
+		"""
+		Constructor
+		
+		"""
+		
+		self.__lock = threading.Lock()
+		self.__started = monotonic()
+		# Command type -> [{counter: n}, {stage: [count, sum, max, histogram]}]
+		self.__cmds = {}
+		# Scheduled PTT, how far from the deadline each write was
+		self.__jitter = [0, 0.0, 0.0, [0] * HIST_BUCKETS]
+		self.__last_jitter = 0.0
+	
+	def jitter(self, late):
+		"""
+		Record a scheduled PTT
+		
+		Arguments:
+			late	--	seconds after the deadline it was written, negative if early
+			
+		"""
+		
+		with self.__lock:
+			self.__add(self.__jitter, abs(late))
+			self.__last_jitter = late
+	
+	def coalesced(self, cat_cmd):
+		""" A command was answered by another exchange """
+		
+		with self.__lock:
+			self.__entry(cat_cmd)[0]['coalesced'] += 1
+	
+	def dropped(self, cat_cmd):
+		""" A command was never sent """
+		
+		with self.__lock:
+			self.__entry(cat_cmd)[0]['dropped'] += 1
+	
+	def resend(self, cat_cmd):
+		""" A command was sent again """
+		
+		with self.__lock:
+			self.__entry(cat_cmd)[0]['resends'] += 1
+	
+	def batched(self, cat_cmd):
+		""" A command shared a write with others """
+		
+		with self.__lock:
+			self.__entry(cat_cmd)[0]['batched'] += 1
+	
+	def cached(self, cat_cmd):
+		""" A get was answered from the rig state """
+		
+		with self.__lock:
+			self.__entry(cat_cmd)[0]['cached'] += 1
+	
+	def suppressed(self, cat_cmd):
+		""" A set was skipped as the radio is already there """
+		
+		with self.__lock:
+			self.__entry(cat_cmd)[0]['suppressed'] += 1
+	
+	def preempted(self, cat_cmd):
+		""" A command gave up its wait for a more important one """
+		
+		with self.__lock:
+			self.__entry(cat_cmd)[0]['preempted'] += 1
+	
+	def record(self, cat_cmd, response, queued, taken, written, answered):
+		"""
+		Record a completed command
+		
+		Arguments:
+			cat_cmd		--	command type
+			response	--	the response tuple
+			queued		--	monotonic time the command was queued
+			taken		--	time the thread took it from the queue
+			written		--	time it was written or None if it was not sent
+			answered	--	time the response was decoded
+			
+		"""
+		
+		r, value = response
+		with self.__lock:
+			counters, stages = self.__entry(cat_cmd)
+			if written == None:
+				counters['dropped' if value in ('UNSUPPORTED', 'TERMINATED') else 'errors'] += 1
+				return
+			counters['count'] += 1
+			if r:
+				counters['ok'] += 1
+			elif value == 'TIMEOUT':
+				counters['timeouts'] += 1
+			elif value == None:
+				counters['naks'] += 1
+			else:
+				counters['errors'] += 1
+			self.__add(stages['queue'], taken - queued)
+			self.__add(stages['send'], written - taken)
+			self.__add(stages['response'], answered - written)
+			self.__add(stages['total'], answered - queued)
+	
+	def snapshot(self):
+		"""
+		Return the stats as a dict
+		
+			{'uptime': seconds,
+			 'commands': {cat_cmd: {counter: n, ...,
+				'latency': {stage: {'count', 'mean_us', 'max_us', 'p50_us', 'p90_us', 'p99_us', 'histogram'}}}},
+			 'ptt_jitter': {as a stage and 'last_us', signed}}
+		
+		Percentiles are the upper edge of the histogram bucket they fall in.
+		
+		"""
+		
+		with self.__lock:
+			commands = {}
+			for cat_cmd, (counters, stages) in self.__cmds.items():
+				result = dict(counters)
+				result['latency'] = {stage: self.__summary(*stages[stage]) for stage in self.STAGES}
+				commands[cat_cmd] = result
+			jitter = self.__summary(*self.__jitter)
+			jitter['last_us'] = self.__last_jitter * 1000000
+			return {'uptime': monotonic() - self.__started, 'commands': commands, 'ptt_jitter': jitter}
+	
+	def __entry(self, cat_cmd):
+		""" Return the stats for a command type, call with the lock held """
+		
+		entry = self.__cmds.get(cat_cmd)
+		if entry == None:
+			entry = ({counter: 0 for counter in self.COUNTERS}, {stage: [0, 0.0, 0.0, [0] * HIST_BUCKETS] for stage in self.STAGES})
+			self.__cmds[cat_cmd] = entry
+		return entry
+	
+	def __add(self, stage, latency):
+		""" Add a latency in seconds to a stage """
+		
+		stage[0] += 1
+		stage[1] += latency
+		if latency > stage[2]:
+			stage[2] = latency
+		stage[3][min(int(latency * 1000000).bit_length(), HIST_BUCKETS - 1)] += 1
+	
+	def __summary(self, count, total, maximum, histogram):
+		""" Return a stage as a dict """
+		
+		summary = {'count': count, 'mean_us': total * 1000000 / count if count > 0 else 0.0, 'max_us': maximum * 1000000, 'histogram': list(histogram)}
+		for p in (50, 90, 99):
+			summary['p%d_us' % p] = 0
+			rank = (p * count + 99) // 100
+			seen = 0
+			for n, bucket in enumerate(histogram):
+				seen += bucket
+				if seen >= rank and count > 0:
+					summary['p%d_us' % p] = 1 << n
+					break
+		return summary
+
+"""
+
+Rig state for the CAT thread.
+
+"""
+class RigState:
+	
+	"""
+	The last known frequency, mode, PTT and lock state of the radio.
+	
+	Values are learnt from sets the radio acknowledged, decoded gets and
+	transceive events, each with the monotonic time it was learnt. A get is
+	answered from here while the values it needs are younger than the TTL.
+	A set that is queued holds back its value until it is answered, so a
+	get never returns what the radio is about to leave. A set that fails,
+	or that the radio does not acknowledge as on the FT-817, leaves the
+	value unknown as we can't tell what the radio did.
+	
+	A frequency or mode set that matches the known value is redundant while
+	the value is younger than the TTL. As only what the radio confirmed is
+	known, a set the radio dropped never makes a later one redundant, and a
+	change made at the front panel since is missed for at most the TTL.
+
+	"""
+	
+	FIELDS = ('freq', 'mode', 'ptt', 'lock')
+	# The field each set changes, each get returns and each event reports
+	SETS = {CAT_FREQ_SET: 'freq', CAT_MODE_SET: 'mode', CAT_PTT: 'ptt', CAT_LOCK: 'lock'}
+	GETS = {CAT_FREQ_GET: ('freq',), CAT_MODE_GET: ('mode',), CAT_FREQ_MODE_GET: ('freq', 'mode')}
+	EVENTS = {CAT_EVT_FREQ: 'freq', CAT_EVT_MODE: 'mode'}
+	
+	def __init__(self, freq_hz, confirms, ttl = STATE_TTL, tolerance = FREQ_TOLERANCE):
+		"""
+		Constructor
+		
+		Arguments:
+			freq_hz		--	callable, returns the Hz the radio is on after a CAT_FREQ_SET
+			confirms	--	callable, True if a successful response to a command shows the radio acted on it
+			ttl			--	seconds a value answers gets
+			tolerance	--	Hz a redundant frequency set may differ by
+		
+		"""
+		
+		self.__lock = threading.Lock()
+		self.__freq_hz = freq_hz
+		self.__confirms = confirms
+		self.__ttl = ttl
+		self.__tolerance = tolerance
+		# field -> [value, monotonic time learnt or None, sets pending]
+		self.__fields = {field: [None, None, 0] for field in self.FIELDS}
+	
+	def set_ttl(self, ttl):
+		"""
+		Change how long values answer gets and make sets redundant
+		
+		Arguments:
+			ttl	--	seconds, 0 to send every get and set to the radio
+		
+		"""
+		
+		self.__ttl = ttl
+	
+	def set_tolerance(self, tolerance):
+		"""
+		Change how close a frequency set must be to be redundant
+		
+		Arguments:
+			tolerance	--	Hz
+		
+		"""
+		
+		self.__tolerance = tolerance
+	
+	def expect(self, cat_cmd):
+		"""
+		A set has been queued
+		
+		Arguments:
+			cat_cmd	--	command type, anything other than a set is ignored
+		
+		"""
+		
+		field = self.SETS.get(cat_cmd)
+		if field != None:
+			with self.__lock:
+				self.__fields[field][2] += 1
+	
+	def settled(self, cat_cmd, param, response):
+		"""
+		A command has completed
+		
+		Arguments:
+			cat_cmd		--	command type
+			param		--	the command parameter
+			response	--	the response tuple
+		
+		"""
+		
+		r, value = response
+		if cat_cmd in self.SETS:
+			field = self.SETS[cat_cmd]
+			# A set that completes without an answer from the radio teaches us nothing
+			confirmed = r and self.__confirms(cat_cmd)
+			if confirmed and cat_cmd == CAT_FREQ_SET:
+				param = self.__freq_hz(param)
+			with self.__lock:
+				entry = self.__fields[field]
+				entry[2] = max(0, entry[2] - 1)
+				if confirmed:
+					entry[0] = param
+					entry[1] = monotonic()
+				else:
+					entry[1] = None
+		elif r and cat_cmd in self.GETS:
+			fields = self.GETS[cat_cmd]
+			if len(fields) == 1:
+				value = (value,)
+			with self.__lock:
+				now = monotonic()
+				for field, v in zip(fields, value):
+					self.__fields[field][0] = v
+					self.__fields[field][1] = now
+	
+	def event(self, evt, value):
+		"""
+		The radio reported a change
+		
+		Arguments:
+			evt		--	CAT_EVT_FREQ | CAT_EVT_MODE
+			value	--	Hz or mode
+		
+		"""
+		
+		field = self.EVENTS.get(evt)
+		if field != None:
+			with self.__lock:
+				self.__fields[field][0] = value
+				self.__fields[field][1] = monotonic()
+	
+	def get(self, cat_cmd):
+		"""
+		Return the response to a get or None if it must go to the radio
+		
+		Arguments:
+			cat_cmd	--	command type
+		
+		"""
+		
+		fields = self.GETS.get(cat_cmd)
+		if fields == None or self.__ttl <= 0:
+			return None
+		values = []
+		with self.__lock:
+			now = monotonic()
+			for field in fields:
+				value, learnt, pending = self.__fields[field]
+				if pending > 0 or learnt == None or now - learnt > self.__ttl:
+					return None
+				values.append(value)
+		if len(values) == 1:
+			return True, values[0]
+		return True, tuple(values)
+	
+	def redundant(self, cat_cmd, param):
+		"""
+		True if a set would leave the radio as it is
+		
+		Arguments:
+			cat_cmd	--	command type
+			param	--	the command parameter
+		
+		"""
+		
+		if cat_cmd == CAT_FREQ_SET:
+			try:
+				hz = self.__freq_hz(param)
+			except (TypeError, ValueError):
+				# Let the command set report it
+				return False
+			field = 'freq'
+		elif cat_cmd == CAT_MODE_SET:
+			field = 'mode'
+		else:
+			return False
+		if self.__ttl <= 0:
+			return False
+		with self.__lock:
+			value, learnt, pending = self.__fields[field]
+			if pending > 0 or learnt == None or monotonic() - learnt > self.__ttl:
+				return False
+			if field == 'freq':
+				return abs(hz - value) <= self.__tolerance
+			return param == value
+	
+	def snapshot(self):
+		""" Return {field: (value, age in seconds)}, the age is None if the value is not known """
+		
+		with self.__lock:
+			now = monotonic()
+			return {field: (value, None if learnt == None else now - learnt) for field, (value, learnt, pending) in self.__fields.items()}
+
+"""
+
+Future for a poll.
+
+"""
+class PollFuture (Future):
+	
+	""" Resolved by a get the poller queued, the response is not passed to the callback """
+
+"""
+
+CAT execution thread for all CAT variants.
+
+"""
+class CATThrd (threading.Thread):
+	
+	def __init__(self, variant, command_set, ip, port, transport, device):
+		"""
+		Constructor
+		
+		Arguments
+			variant		--	CAT command set variant
+			command_set	--	command set to use
+			ip			--	UDP enpoint
+			port		--	UDP endpoint
+			transport	--	CAT_UDP | CAT_SERIAL
+			device   	--  an open device for the transport
+		"""
+
+		super(CATThrd, self).__init__()
+		
+		self.__variant = variant
+		self.__command_set = command_set
+		self.__ip = ip
+		self.__port = port
+		self.__transport = transport
+		self.__device = device
+		self.__callback = None
+		self.__subscribers = []
+		
+		# Class vars
+		self.__cat_cls_inst = self.__command_set[CLASS](command_set)
+		self.__q = CATQueue()
+		# If the radio returns frequency and mode together merge queued gets
+		self.__merge_gets = self.__cat_cls_inst.supports(CAT_FREQ_MODE_GET)
+		# The thread sleeps on this until there is work to do
+		self.__cond = threading.Condition()
+		# An ICOM serial link is read by its own thread so we see unsolicited frames
+		self.__framer = None
+		self.__reader = None
+		if self.__command_set[CLASS] == ICOM and self.__transport == CAT_SERIAL:
+			self.__framer = CIVFramer()
+			self.__reader = CIVReader(self.__device, self.__framer, self.__cond)
+		# A UDP link is read by its own thread so requests can be pipelined
+		self.__replies = deque()
+		# Receive buffers are reused, the decoders are given views into them
+		self.__rx = bytearray(RX_SIZE)
+		self.__rx_view = memoryview(self.__rx)
+		self.__rx_resp = self.__rx_view[:self.__command_set[SERIAL][READ_SZ]]
+		self.__rx_free = deque(bytearray(RX_SIZE) for i in range(UDP_WINDOW * 2))
+		if self.__transport == CAT_UDP:
+			self.__reader = UDPReader(self.__device, self.__replies, self.__rx_free, self.__cond)
+		# Decoded unsolicited changes waiting to go to subscribers
+		self.__events = []
+		# Serial pacing, time for one character on the wire and when we can next send
+		self.__char_time = 0
+		if self.__transport == CAT_SERIAL:
+			self.__char_time = char_time(self.__device.baudrate, self.__command_set[SERIAL][PARITY], self.__command_set[SERIAL][STOP_BITS])
+		self.__next_send = 0
+		# Command statistics, optionally reported every interval
+		self.__stats = CATStats()
+		self.__stats_callback = None
+		self.__stats_interval = STATS_INTERVAL
+		self.__stats_due = 0
+		# Optional record of the wire traffic
+		self.__recorder = None
+		# Scheduled PTT, a heap of (at, sequence, state, frame, futures, queued)
+		self.__scheduled = []
+		self.__scheduled_seq = 0
+		# Set when a query gives up its wait for a more important command
+		self.__preempted = False
+		# Sets can share a write when the radio needs no gap between commands
+		self.__gather = self.__transport == CAT_SERIAL and self.__command_set[SERIAL][GAP] == 0
+		# What we know of the radio, answers gets while it is fresh
+		self.__state = RigState(self.__cat_cls_inst.set_freq_hz, self.__cat_cls_inst.confirms)
+		# Background polling, off until set_polling()
+		self.__poll_fast = None
+		self.__poll_slow = None
+		self.__poll_interval = None
+		self.__poll_due = 0
+		# Gets of the current poll still to be answered, the values last read and if they changed
+		self.__poll_outstanding = 0
+		self.__poll_last = {}
+		self.__poll_changed = False
+		# Terminate flag
+		self.__terminate = False
+	
+	def set_callback(self, callback):
+		"""
+		Callback here with responses
+		
+		Arguments:
+			callback	-- 	the callable
+			
+		"""
+		
+		self.__callback = callback
+	
+	def subscribe(self, callback):
+		"""
+		Callback here with unsolicited changes
+		
+		Arguments:
+			callback	-- 	the callable
+			
+		"""
+		
+		# Copy on write so the thread can iterate without a lock
+		if callback not in self.__subscribers:
+			self.__subscribers = self.__subscribers + [callback]
+	
+	def unsubscribe(self, callback):
+		"""
+		Stop callbacks with unsolicited changes
+		
+		Arguments:
+			callback	-- 	the callable
+			
+		"""
+		
+		self.__subscribers = [s for s in self.__subscribers if s != callback]
+	
+	def set_stats_callback(self, callback, interval):
+		"""
+		Callback here with a stats snapshot every interval seconds
+		
+		Arguments:
+			callback	--	the callable, None to stop
+			interval	--	seconds between calls
+			
+		"""
+		
+		with self.__cond:
+			self.__stats_callback = callback
+			self.__stats_interval = interval
+			self.__stats_due = monotonic() + interval
+			# The thread may be waiting with no timeout
+			self.__cond.notify()
+	
+	def set_recorder(self, recorder):
+		"""
+		Record all wire traffic
+		
+		Arguments:
+			recorder	--	a catlog.CATRecorder or None
+			
+		"""
+		
+		self.__recorder = recorder
+	
+	def stats(self):
+		""" Return a stats snapshot, see CATStats """
+		
+		return self.__stats.snapshot()
+		
+	def set_state_ttl(self, ttl):
+		"""
+		Change how long the rig state answers gets and makes sets redundant
+		
+		Arguments:
+			ttl	--	seconds, 0 to send every get and set to the radio
+		
+		"""
+		
+		self.__state.set_ttl(ttl)
+	
+	def set_freq_tolerance(self, tolerance):
+		"""
+		Change how close a frequency set must be to the radio to be skipped
+		
+		Arguments:
+			tolerance	--	Hz
+		
+		"""
+		
+		self.__state.set_tolerance(tolerance)
+	
+	def set_polling(self, fast, slow):
+		"""
+		Start or stop background reads of the frequency and mode
+		
+		Arguments:
+			fast	--	seconds between reads while the radio is changing, None to stop
+			slow	--	most seconds between reads while it is not
+		
+		"""
+		
+		with self.__cond:
+			self.__poll_fast = fast
+			self.__poll_slow = slow
+			self.__poll_interval = fast
+			self.__poll_due = monotonic()
+			# The thread may be waiting with no timeout
+			self.__cond.notify()
+	
+	def state(self):
+		""" Return a rig state snapshot, see RigState """
+		
+		return self.__state.snapshot()
+
+	def terminate(self):
+		""" Asked to terminate the thread """
+		
+		with self.__cond:
+			self.__terminate = True
+			self.__cond.notify()
+		self.join()
+	
+	def do_command(self, cat_cmd, params, force = False):
+		"""
+		Execute a new CAT command
+		
+		Arguments:
+			cat_cmd	-- 	from the CAT command enumerations
+			params	--	required parameters for the command
+			force	--	True to send the command even if the rig state answers it
+		
+		Returns a Future that resolves with the same response tuple
+		that is passed to the callback.
+			
+		"""
+		
+		future = Future()
+		if not force and self.__cat_cls_inst.supports(cat_cmd):
+			# A fresh answer or a set that changes nothing is returned at once,
+			# the callback is made on this thread. A command the radio does not
+			# support goes to the thread and is failed there.
+			response = self.__state.get(cat_cmd)
+			if response != None:
+				self.__stats.cached(cat_cmd)
+				self.__respond([future], response)
+				return future
+			if self.__state.redundant(cat_cmd, params):
+				self.__stats.suppressed(cat_cmd)
+				self.__respond([future], (True, None))
+				return future
+		# We add the command to the Q for execution by the thread
+		# Note we are only interested in the last frequency so the Q coalesces frequency
+		# sets. Other commands are never discarded, see CATQueue.
+		with self.__cond:
+			if self.__q.put(cat_cmd, params, future):
+				self.__stats.coalesced(cat_cmd)
+			else:
+				self.__state.expect(cat_cmd)
+			# Wake the thread
+			self.__cond.notify()
+		return future
+	
+	def schedule_ptt(self, at, state):
+		"""
+		Switch PTT at a given time
+		
+		Arguments:
+			at		--	time.monotonic() value to switch at
+			state	--	True for transmit
+		
+		Returns a Future that resolves with the response tuple.
+			
+		"""
+		
+		future = Future()
+		with self.__cond:
+			# Formatted now so there is nothing to do at the deadline,
+			# with the lock held as the frame cache is shared with the thread
+			(r, cmd_buf) = self.__cat_cls_inst.format_cat_cmd(CAT_PTT, state)
+			if not r:
+				future.set_result((False, 'UNSUPPORTED'))
+				return future
+			self.__scheduled_seq += 1
+			heapq.heappush(self.__scheduled, (at, self.__scheduled_seq, state, cmd_buf, [future], monotonic()))
+			self.__state.expect(CAT_PTT)
+			# The thread may need to wake earlier
+			self.__cond.notify()
+		return future
+				
+	def run(self):
+		
+		""" Thread entry point """
+		
+		#
+		# Handles all CAT interactions with an external tranceiver
+		#
+		#	Tracking - keep antenna resonance in line with received frequency
+		#	Calibration - automatic setpoint calibration - TBD
+		#
+		
+		if self.__reader != None:
+			self.__reader.start()
+		
+		if self.__transport == CAT_UDP:
+			self.__run_udp()
+		else:
+			self.__run_serial()
+		
+		if self.__reader != None:
+			self.__reader.terminate()
+			self.__reader.join()
+		
+		# Anything left over will never be executed
+		with self.__cond:
+			for at, seq, state, cmd_buf, futures, queued in self.__scheduled:
+				self.__stats.dropped(CAT_PTT)
+				futures[0].set_result((False, 'TERMINATED'))
+			self.__scheduled = []
+			while len(self.__q) > 0:
+				entry = self.__q.get()
+				for future in entry[2]:
+					self.__stats.dropped(entry[0])
+					future.set_result((False, 'TERMINATED'))
+	
+	def __next_command(self):
+		"""
+		Return the next (cmd, param, futures, queued) or None, call with the lock held
+		
+		"""
+		
+		entry = self.__q.get()
+		if entry == None:
+			return None
+		cmd, param, futures, queued = entry
+		if cmd in FREQ_MODE_PARTS and self.__merge_gets:
+			# One exchange answers any pending freq and mode gets
+			if cmd != CAT_FREQ_MODE_GET:
+				self.__stats.coalesced(cmd)
+			futures = {cmd: futures}
+			for other in FREQ_MODE_PARTS:
+				entry = self.__q.take(other)
+				if entry != None:
+					futures[other] = entry[2]
+					queued = min(queued, entry[3])
+					self.__stats.coalesced(other)
+			cmd = CAT_FREQ_MODE_GET
+		return cmd, param, futures, queued
+	
+	def __run_serial(self):
+		""" Serial link, one exchange at a time """
+			
+		while not self.__terminate:
+			futures = None
+			batch = None
+			try:
+				# Wait for work, we are woken by do_command(), schedule_ptt(), terminate() or the reader
+				with self.__cond:
+					while len(self.__q) == 0 and not self.__terminate:
+						if self.__framer != None:
+							for frame in self.__framer.frames():
+								self.__unsolicited(frame)
+							if len(self.__events) > 0:
+								break
+						timeout = self.__wait_timeout()
+						if timeout != None and timeout <= 0:
+							break
+						self.__cond.wait(timeout)
+					self.__poll()
+				self.__dispatch_events()
+				self.__report_stats()
+				self.__serial_scheduled(PTT_WAKE)
+				# Requests are queued
+				while not self.__terminate:
+					# Get the command,
+					with self.__cond:
+						command = self.__next_command()
+					if command == None:
+						break
+					cmd, param, futures, queued = command
+					taken = monotonic()
+					written = None
+					# format,
+					(r, cmd_buf) = self.__format(cmd, param)
+					if not r:
+						self.__complete(cmd, param, futures, (False, 'UNSUPPORTED'), queued, taken, None)
+						continue
+					# with any sets that follow,
+					batch = deque([[cmd, param, cmd_buf, futures, queued]])
+					futures = None
+					if self.__gather and not self.__cat_cls_inst.is_response(cmd):
+						self.__gather_sets(batch, taken)
+					size = 0
+					for entry in batch:
+						size += len(entry[2])
+					# keep the line clear for a scheduled PTT due before the exchange is over
+					if len(self.__scheduled) > 0:
+						pacing = max(0, self.__next_send - monotonic())
+						self.__serial_scheduled(pacing + (size + len(batch) * self.__command_set[SERIAL][READ_SZ]) * self.__char_time + self.__command_set[SERIAL][GAP] + PTT_GUARD)
+					# and send when the radio is ready for it
+					self.__pace(size)
+					if len(batch) == 1:
+						self.__device.write(cmd_buf)
+					else:
+						self.__device.write(b''.join([entry[2] for entry in batch]))
+						for entry in batch:
+							self.__stats.batched(entry[0])
+					written = monotonic()
+					if self.__recorder != None:
+						for entry in batch:
+							self.__recorder.record(LOG_TX, self.__variant, entry[0], entry[2])
+					# Responses come back in the order the frames were sent
+					while len(batch) > 0:
+						cmd, param, cmd_buf, futures, queued = batch.popleft()
+						self.__serial_response(cmd, param, cmd_buf, futures, queued, taken, written)
+						futures = None
+					self.__dispatch_events()
+					self.__report_stats()
+			except Exception as e:
+				# Oops
+				if futures != None:
+					self.__complete(cmd, param, futures, (False, 'ERROR [%s]' % (str(e))), queued, taken, written)
+				else:
+					self.__respond(None, (False, 'ERROR [%s]' % (str(e))))
+				# Anything else in the write failed with it
+				while batch != None and len(batch) > 0:
+					cmd, param, cmd_buf, futures, queued = batch.popleft()
+					self.__complete(cmd, param, futures, (False, 'ERROR [%s]' % (str(e))), queued, taken, written)
+				futures = None
+	
+	def __gather_sets(self, batch, taken):
+		"""
+		Add the sets at the head of the queue to a write
+		
+		Arguments:
+			batch	--	deque of [cmd, param, frame, futures, queued] to add to
+			taken	--	time the first was taken from the queue
+		
+		Sets are the safety and control classes. A command that needs a
+		response ends the batch and goes back to the queue.
+		
+		"""
+		
+		while len(batch) < WRITE_BATCH:
+			with self.__cond:
+				priority = self.__q.priority()
+				if priority == None or priority == PRIORITY_QUERY:
+					return
+				command = self.__next_command()
+			cmd, param, futures, queued = command
+			if not self.__cat_cls_inst.supports(cmd):
+				self.__complete(cmd, param, futures, (False, 'UNSUPPORTED'), queued, taken, None)
+				continue
+			if self.__cat_cls_inst.is_response(cmd):
+				with self.__cond:
+					self.__q.requeue([cmd, param, futures, queued])
+				return
+			try:
+				(r, cmd_buf) = self.__format(cmd, param)
+			except Exception as e:
+				# Only this command fails, the batch goes ahead
+				self.__complete(cmd, param, futures, (False, 'ERROR [%s]' % (str(e))), queued, taken, None)
+				continue
+			if not r:
+				self.__complete(cmd, param, futures, (False, 'UNSUPPORTED'), queued, taken, None)
+				continue
+			batch.append([cmd, param, cmd_buf, futures, queued])
+	
+	def __format(self, cmd, param):
+		"""
+		Return (r, frame) for a command
+		
+		Arguments:
+			cmd		--	command type
+			param	--	the command parameter
+		
+		The frame cache is not locked and schedule_ptt() also formats, so
+		both do it with the lock held.
+		
+		"""
+		
+		with self.__cond:
+			return self.__cat_cls_inst.format_cat_cmd(cmd, param)
+	
+	def __serial_response(self, cmd, param, cmd_buf, futures, queued, taken, written):
+		"""
+		Read and return the response to a command just written
+		
+		Arguments:
+			cmd			--	command type
+			param		--	the command parameter
+			cmd_buf		--	the command bytes
+			futures		--	as __respond()
+			queued		--	as __complete()
+			taken		--	as __complete()
+			written		--	as __complete()
+			
+		"""
+		
+		# We do not assume a response on Serial
+		if self.__cat_cls_inst.is_response(cmd):
+			if self.__command_set[CLASS] == ICOM:
+				data = self.__read_civ_frame(cmd_buf, CAT_PRIORITY.get(cmd) == PRIORITY_QUERY)
+				if self.__recorder != None and data != None: self.__recorder.record(LOG_RX, self.__variant, cmd, data)
+				if self.__preempted:
+					# Something more important is waiting, ask again after it.
+					# A late answer is not accepted by the next command's wait.
+					self.__stats.preempted(cmd)
+					with self.__cond:
+						self.__q.requeue([cmd, param, futures, queued])
+					return
+			else:
+				data = self.__rx_resp
+				n = self.__device.readinto(data)
+				if self.__recorder != None and n > 0: self.__recorder.record(LOG_RX, self.__variant, cmd, data[:n])
+				if n < len(data):
+					data = None
+			if data == None:
+				self.__complete(cmd, param, futures, (False, 'TIMEOUT'), queued, taken, written)
+				return
+			self.__paced_response()
+			# Return data to the caller
+			# Note, this is an async return
+			response = self.__cat_cls_inst.decode_cat_resp(CAT_COMMAND_SETS[self.__variant], cmd, data)
+			self.__complete(cmd, param, futures, response, queued, taken, written)
+		else:
+			# There may be an ack/nak response
+			data = None
+			if self.__command_set[CLASS] == ICOM:
+				data = self.__read_civ_frame(cmd_buf)
+				if self.__recorder != None and data != None: self.__recorder.record(LOG_RX, self.__variant, cmd, data)
+			if data == None:
+				data = bytearray()
+			else:
+				self.__paced_response()
+			response = self.__cat_cls_inst.ack_nak(CAT_COMMAND_SETS[self.__variant], data)
+			self.__complete(cmd, param, futures, response, queued, taken, written)
+	
+	def __serial_scheduled(self, within):
+		"""
+		Send any scheduled PTT due within the given time
+		
+		Arguments:
+			within	--	seconds
+		
+		"""
+		
+		for at, state, cmd_buf, futures, queued, taken in self.__due_scheduled(within):
+			written = None
+			try:
+				self.__wait_until(at)
+				self.__device.write(cmd_buf)
+				written = monotonic()
+				self.__stats.jitter(written - at)
+				# The deadline comes before pacing but the next command still waits
+				self.__next_send = written + len(cmd_buf) * self.__char_time + self.__command_set[SERIAL][GAP]
+				if self.__recorder != None: self.__recorder.record(LOG_TX, self.__variant, CAT_PTT, cmd_buf)
+				self.__serial_response(CAT_PTT, state, cmd_buf, futures, queued, taken, written)
+			except Exception as e:
+				self.__complete(CAT_PTT, state, futures, (False, 'ERROR [%s]' % (str(e))), queued, taken, written)
+	
+	def __due_scheduled(self, within):
+		"""
+		Remove and return the scheduled PTT due within the given time
+		
+		Arguments:
+			within	--	seconds
+		
+		Returns a list of (at, state, frame, futures, queued, taken) in deadline order.
+		
+		"""
+		
+		due = []
+		if len(self.__scheduled) == 0:
+			return due
+		with self.__cond:
+			limit = monotonic() + within
+			while len(self.__scheduled) > 0 and self.__scheduled[0][0] <= limit:
+				at, seq, state, cmd_buf, futures, queued = heapq.heappop(self.__scheduled)
+				due.append((at, state, cmd_buf, futures, queued, monotonic()))
+		return due
+	
+	def __wait_until(self, at):
+		"""
+		Return at the given monotonic time
+		
+		Arguments:
+			at	--	the deadline
+		
+		The sleep ends PTT_SPIN early and the rest is a busy wait, which is
+		far more precise than the OS timer.
+		
+		"""
+		
+		remaining = at - monotonic()
+		if remaining > PTT_SPIN:
+			sleep(remaining - PTT_SPIN)
+		while monotonic() < at:
+			pass
+	
+	def __pace(self, n):
+		"""
+		Wait until the radio can accept a command
+		
+		Arguments:
+			n	--	number of bytes about to be written
+		
+		The write returns as soon as the bytes are buffered, so the next command
+		can go when these have been on the wire for n character times and the
+		radio has had the inter-command gap from the command set.
+		
+		"""
+		
+		now = monotonic()
+		if self.__next_send > now:
+			sleep(self.__next_send - now)
+			now = self.__next_send
+		self.__next_send = now + n * self.__char_time + self.__command_set[SERIAL][GAP]
+	
+	def __paced_response(self):
+		""" A response has arrived, the radio needs the gap before the next command """
+		
+		self.__next_send = max(self.__next_send, monotonic() + self.__command_set[SERIAL][GAP])
+	
+	def __run_udp(self):
+		"""
+		UDP link, requests are pipelined
+		
+		Up to UDP_WINDOW requests are in flight at once. The UDPReader queues
+		replies which are matched to the oldest request of the same command
+		type. Each request has its own deadline and is resent up to UDP_RETRIES
+		times, so a lost datagram only delays the request it belonged to.
+		
+		"""
+		
+		in_flight = []
+		while not self.__terminate:
+			req = None
+			replies = []
+			try:
+				with self.__cond:
+					# Wait for a reply, a deadline or room for a new request
+					while not self.__terminate and len(self.__replies) == 0 and not self.__udp_room(len(in_flight)):
+						timeout = self.__wait_timeout()
+						if len(in_flight) > 0:
+							deadline = min(r.deadline for r in in_flight) - monotonic()
+							timeout = deadline if timeout == None else min(timeout, deadline)
+						if timeout != None and timeout <= 0:
+							break
+						self.__cond.wait(timeout)
+					self.__poll()
+					replies = list(self.__replies)
+					self.__replies.clear()
+				self.__report_stats()
+				self.__dispatch_events()
+				
+				# Scheduled PTT goes at its deadline, each on its own so one failure loses no other
+				for at, state, cmd_buf, futures, queued, taken in self.__due_scheduled(PTT_WAKE):
+					req = UDPRequest(CAT_PTT, state, futures)
+					req.cmd_buf = cmd_buf
+					req.queued = queued
+					req.taken = taken
+					try:
+						self.__wait_until(at)
+						self.__device.sendto(cmd_buf, (self.__ip, self.__port))
+						req.written = monotonic()
+						self.__stats.jitter(req.written - at)
+						if self.__recorder != None: self.__recorder.record(LOG_TX, self.__variant, CAT_PTT, cmd_buf)
+						if self.__command_set[CLASS] != ICOM:
+							self.__complete(CAT_PTT, state, futures, self.__cat_cls_inst.ack_nak(CAT_COMMAND_SETS[self.__variant], bytearray()), req.queued, req.taken, req.written)
+							continue
+						req.deadline = req.written + UDP_TIMEOUT
+						in_flight.append(req)
+					except Exception as e:
+						self.__complete(CAT_PTT, state, futures, (False, 'ERROR [%s]' % (str(e))), req.queued, req.taken, req.written)
+				req = None
+				
+				# Match replies to requests
+				while len(replies) > 0:
+					self.__udp_reply(replies.pop(0), in_flight)
+				self.__dispatch_events()
+				# Resend or fail anything past its deadline
+				now = monotonic()
+				for req in list(in_flight):
+					if now >= req.deadline:
+						if req.retries > 0:
+							req.retries -= 1
+							req.deadline = now + UDP_TIMEOUT
+							self.__stats.resend(req.cmd)
+							self.__device.sendto(req.cmd_buf, (self.__ip, self.__port))
+							if self.__recorder != None: self.__recorder.record(LOG_TX, self.__variant, req.cmd, req.cmd_buf)
+						else:
+							in_flight.remove(req)
+							self.__complete(req.cmd, req.param, req.futures, (False, 'TIMEOUT'), req.queued, req.taken, req.written)
+				req = None
+				# Send new requests, each is only taken from the queue when it is sent
+				# so a failure can lose no more than the one request
+				while True:
+					with self.__cond:
+						if not self.__udp_room(len(in_flight)):
+							break
+						command = self.__next_command()
+					if command == None:
+						break
+					cmd, param, futures, queued = command
+					req = UDPRequest(cmd, param, futures)
+					req.queued = queued
+					req.taken = monotonic()
+					(r, req.cmd_buf) = self.__format(cmd, param)
+					if not r:
+						self.__complete(cmd, param, futures, (False, 'UNSUPPORTED'), req.queued, req.taken, None)
+						continue
+					self.__device.sendto(req.cmd_buf, (self.__ip, self.__port))
+					req.written = monotonic()
+					if self.__recorder != None: self.__recorder.record(LOG_TX, self.__variant, cmd, req.cmd_buf)
+					if not self.__cat_cls_inst.is_response(cmd) and self.__command_set[CLASS] != ICOM:
+						# Only CI-V answers a set, as on Serial
+						self.__complete(cmd, param, futures, self.__cat_cls_inst.ack_nak(CAT_COMMAND_SETS[self.__variant], bytearray()), req.queued, req.taken, req.written)
+						continue
+					req.deadline = monotonic() + UDP_TIMEOUT
+					in_flight.append(req)
+				req = None
+			except Exception as e:
+				# Oops
+				if req != None:
+					if req in in_flight:
+						in_flight.remove(req)
+					self.__complete(req.cmd, req.param, req.futures, (False, 'ERROR [%s]' % (str(e))), req.queued, req.taken, req.written)
+				elif self.__callback != None:
+					self.__callback((False, 'ERROR [%s]' % (str(e))))
+				# The reader can have back the buffers of any replies not yet matched
+				while len(replies) > 0:
+					self.__rx_free.append(replies.pop(0).obj)
+		
+		for req in in_flight:
+			self.__complete(req.cmd, req.param, req.futures, (False, 'TERMINATED'), req.queued, req.taken, None)
+	
+	def __udp_reply(self, data, in_flight):
+		"""
+		Match a UDP reply to the oldest request it could answer and complete it
+		
+		Arguments:
+			data		--	the reply, a memoryview of a receive buffer
+			in_flight	--	requests in flight, the matched one is removed
+		
+		A reply that fails to decode fails only the request it matched. A CI-V
+		frame that matches none is unsolicited, as on a serial link.
+		
+		"""
+		
+		matched = None
+		try:
+			for req in in_flight:
+				if self.__cat_cls_inst.match_reply(req.cmd, req.cmd_buf, data):
+					matched = req
+					in_flight.remove(req)
+					break
+			if matched == None:
+				if self.__command_set[CLASS] == ICOM and len(data) >= MIN_FRAME:
+					with self.__cond:
+						self.__unsolicited(data)
+				elif self.__recorder != None:
+					self.__recorder.record(LOG_RX, self.__variant, None, data)
+			else:
+				if self.__recorder != None: self.__recorder.record(LOG_RX, self.__variant, matched.cmd, data)
+				if self.__cat_cls_inst.is_response(matched.cmd):
+					response = self.__cat_cls_inst.decode_cat_resp(CAT_COMMAND_SETS[self.__variant], matched.cmd, data)
+				else:
+					response = self.__cat_cls_inst.ack_nak(CAT_COMMAND_SETS[self.__variant], data)
+				self.__complete(matched.cmd, matched.param, matched.futures, response, matched.queued, matched.taken, matched.written)
+		except Exception as e:
+			if matched != None:
+				self.__complete(matched.cmd, matched.param, matched.futures, (False, 'ERROR [%s]' % (str(e))), matched.queued, matched.taken, matched.written)
+			else:
+				self.__respond(None, (False, 'ERROR [%s]' % (str(e))))
+		finally:
+			# Decoded, the reader can have the buffer back
+			self.__rx_free.append(data.obj)
+	
+	def __complete(self, cmd, param, futures, response, queued, taken, written):
+		"""
+		Record a command in the stats and rig state and return the response to the caller
+		
+		Arguments:
+			cmd			--	command type
+			param		--	the command parameter
+			futures		--	as __respond()
+			response	--	the response tuple
+			queued		--	monotonic time the command was queued
+			taken		--	time it was taken from the queue
+			written		--	time it was sent or None if it was not
+			
+		"""
+		
+		self.__stats.record(cmd, response, queued, taken, written, monotonic())
+		self.__state.settled(cmd, param, response)
+		self.__respond(futures, response)
+	
+	def __wait_timeout(self):
+		""" Seconds until the stats callback, a scheduled PTT or a poll is due or None, call with the lock held """
+		
+		timeout = None
+		if self.__stats_callback != None:
+			timeout = self.__stats_due - monotonic()
+		if self.__poll_fast != None and self.__poll_outstanding == 0:
+			poll = self.__poll_due - monotonic()
+			timeout = poll if timeout == None else min(timeout, poll)
+		if len(self.__scheduled) > 0:
+			ptt = self.__scheduled[0][0] - PTT_WAKE - monotonic()
+			timeout = ptt if timeout == None else min(timeout, ptt)
+		return timeout
+	
+	def __report_stats(self):
+		""" Call the stats callback if it is due """
+		
+		callback = self.__stats_callback
+		if callback == None or monotonic() < self.__stats_due:
+			return
+		self.__stats_due = monotonic() + self.__stats_interval
+		callback(self.__stats.snapshot())
+	
+	def __poll(self):
+		""" Queue the gets for a poll if one is due, call with the lock held """
+		
+		if self.__poll_fast == None or self.__poll_outstanding > 0 or monotonic() < self.__poll_due:
+			return
+		if self.__merge_gets:
+			cmds = (CAT_FREQ_MODE_GET,)
+		else:
+			cmds = (CAT_FREQ_GET, CAT_MODE_GET)
+		self.__poll_outstanding = len(cmds)
+		for cmd in cmds:
+			future = PollFuture()
+			# Joins any get that is already pending
+			self.__q.put(cmd, None, future)
+			future.add_done_callback(lambda future, cmd = cmd: self.__polled(cmd, future))
+	
+	def __polled(self, cmd, future):
+		"""
+		A poll get was answered
+		
+		Arguments:
+			cmd		--	the get
+			future	--	its PollFuture
+		
+		"""
+		
+		r, value = future.result()
+		with self.__cond:
+			if r:
+				if cmd == CAT_FREQ_MODE_GET:
+					readings = ((CAT_EVT_FREQ, value[0]), (CAT_EVT_MODE, value[1]))
+				elif cmd == CAT_FREQ_GET:
+					readings = ((CAT_EVT_FREQ, value),)
+				else:
+					readings = ((CAT_EVT_MODE, value),)
+				for evt, reading in readings:
+					if self.__poll_last.get(evt) != reading:
+						self.__poll_last[evt] = reading
+						self.__poll_changed = True
+						if len(self.__subscribers) > 0:
+							self.__events.append((evt, reading))
+			self.__poll_outstanding -= 1
+			if self.__poll_outstanding > 0 or self.__poll_fast == None:
+				return
+			# Fast while the radio is changing, backing off while it is not
+			if self.__poll_changed:
+				self.__poll_interval = self.__poll_fast
+			else:
+				self.__poll_interval = min(self.__poll_interval * POLL_BACKOFF, self.__poll_slow)
+			self.__poll_changed = False
+			self.__poll_due = monotonic() + self.__poll_interval
+	
+	def __udp_room(self, in_flight):
+		"""
+		True if the next command can be sent, call with the lock held
+		
+		Arguments:
+			in_flight	--	requests in flight
+		
+		The last place in the window is kept for safety and control
+		commands so they never wait behind queries.
+		
+		"""
+		
+		priority = self.__q.priority()
+		if priority == None:
+			return False
+		return in_flight < (UDP_WINDOW if priority < PRIORITY_QUERY else UDP_WINDOW - 1)
+	
+	def __respond(self, futures, response):
+		"""
+		Return a response to the caller
+		
+		Arguments:
+			futures		--	the Futures for the command, a dict of command type: Futures
+							for merged gets, or None
+			response	--	the response tuple
+			
+		"""
+		
+		if isinstance(futures, dict):
+			# Merged gets, each caller gets their part of the combined response
+			for cat_cmd, cmd_futures in futures.items():
+				r, value = response
+				if r and FREQ_MODE_PARTS[cat_cmd] != None:
+					value = value[FREQ_MODE_PARTS[cat_cmd]]
+				self.__respond(cmd_futures, (r, value))
+			return
+		if self.__callback != None and (futures == None or not all(isinstance(future, PollFuture) for future in futures)):
+			self.__callback(response)
+		if futures != None:
+			for future in futures:
+				if not future.done():
+					future.set_result(response)
+	
+	def __read_civ_frame(self, cmd_buf, preempt = False):
+		"""
+		Wait for the CI-V frame that answers a command
+		
+		Arguments:
+			cmd_buf	--	the command we sent
+			preempt	--	True to give up if a more important command is queued
+						or a scheduled PTT is due
+		
+		Returns a view of the frame in the receive buffer or None on timeout
+		or preemption, when self.__preempted is set.
+		
+		"""
+		
+		# Our own echo is dropped by the framer. The answer is either the data
+		# for our command number or an OK/NG frame, anything else is stale or unsolicited.
+		accept = (cmd_buf[CMD], self.__command_set[RESPONSES][ACK], self.__command_set[RESPONSES][NAK])
+		deadline = monotonic() + self.__command_set[SERIAL][TIMEOUT]
+		self.__preempted = False
+		with self.__cond:
+			while True:
+				for frame in self.__framer.frames():
+					if frame[TO_ADDR] == CONTROLLER and frame[CMD] in accept:
+						# The framer buffer is refilled once we release the lock
+						n = len(frame)
+						self.__rx_view[:n] = frame
+						return self.__rx_view[:n]
+					self.__unsolicited(frame)
+				remaining = deadline - monotonic()
+				if remaining <= 0 or self.__terminate:
+					# Timeout, nothing more is coming
+					return None
+				if preempt:
+					# do_command() and schedule_ptt() notify us
+					if self.__q.waiting_above(PRIORITY_QUERY):
+						self.__preempted = True
+						return None
+					if len(self.__scheduled) > 0:
+						ptt = self.__scheduled[0][0] - PTT_WAKE - monotonic()
+						if ptt <= 0:
+							self.__preempted = True
+							return None
+						remaining = min(remaining, ptt)
+				self.__cond.wait(remaining)
+	
+	def __unsolicited(self, frame):
+		"""
+		Decode an unsolicited frame, call with the lock held
+		
+		Arguments:
+			frame	--	the CI-V frame
+		
+		"""
+		
+		if self.__recorder != None: self.__recorder.record(LOG_RX, self.__variant, None, frame)
+		if frame[TO_ADDR] != BROADCAST:
+			return
+		event = self.__cat_cls_inst.decode_transceive(CAT_COMMAND_SETS[self.__variant], frame)
+		if event != None:
+			self.__state.event(*event)
+			if len(self.__subscribers) > 0:
+				self.__events.append(event)
+	
+	def __dispatch_events(self):
+		""" Send any unsolicited changes to the subscribers """
+		
+		if len(self.__events) == 0:
+			return
+		with self.__cond:
+			events = self.__events
+			self.__events = []
+		for event in events:
+			for subscriber in self.__subscribers:
+				subscriber(*event)
+
+def char_time(baud, parity, stop_bits):
+	"""
+	Return the time in seconds for one character on a serial line
+	
+	Arguments:
+		baud		--	baud rate
+		parity		--	PARITY_NONE | PARITY_EVEN | PARITY_ODD
+		stop_bits	--	STOPBITS_ONE | STOPBITS_TWO
+		
+	"""
+	
+	# Start bit, 8 data bits, optional parity bit and the stop bits
+	bits = 1 + 8 + (0 if parity == PARITY_NONE else 1) + stop_bits
+	return bits / float(baud)
+
+"""
+
+UDP link support
+
+"""
+class UDPRequest:
+	
+	""" A request in flight on a UDP link """
+	
+	__slots__ = ('cmd', 'param', 'futures', 'cmd_buf', 'deadline', 'retries', 'queued', 'taken', 'written')
+	
+	def __init__(self, cmd, param, futures):
+		"""
+		Constructor
+		
+		Arguments:
+			cmd		--	command type
+			param	--	the command parameter
+			futures	--	Futures to resolve with the response
+			
+		"""
+		
+		self.cmd = cmd
+		self.param = param
+		self.futures = futures
+		self.cmd_buf = None
+		self.deadline = 0
+		self.retries = UDP_RETRIES
+		# Monotonic times for the stats
+		self.queued = 0
+		self.taken = 0
+		self.written = None
+
+class UDPReader (threading.Thread):
+	
+	"""
+	Reads replies from the UDP socket and queues them for the CAT thread.
+	Each reply is received into a buffer taken from the free deque and queued
+	as a memoryview of the datagram. The CAT thread puts the buffer back once
+	the reply has been decoded.
+	
+	"""
+	
+	def __init__(self, sock, replies, free, cond):
+		"""
+		Constructor
+		
+		Arguments:
+			sock	--	the non-blocking UDP socket
+			replies	--	deque to append replies to
+			free	--	deque of receive buffers
+			cond	--	the threading.Condition protecting replies
+			
+		"""
+		
+		super(UDPReader, self).__init__()
+		
+		self.__sock = sock
+		self.__replies = replies
+		self.__free = free
+		self.__cond = cond
+		# Written to by terminate() to release select()
+		self.__wake_r, self.__wake_w = socket.socketpair()
+		self.__terminate = False
+	
+	def terminate(self):
+		""" Asked to terminate the thread """
+		
+		self.__terminate = True
+		self.__wake_w.send(b'\x00')
+	
+	def run(self):
+		""" Thread entry point """
+		
+		while not self.__terminate:
+			r, w, x = select.select([self.__sock, self.__wake_r], [], [])
+			if self.__sock not in r:
+				continue
+			# Only a burst of stale replies can empty the free list
+			buf = self.__free.pop() if len(self.__free) > 0 else bytearray(RX_SIZE)
+			try:
+				n, addr = self.__sock.recvfrom_into(buf)
+			except (BlockingIOError, InterruptedError):
+				self.__free.append(buf)
+				continue
+			except OSError:
+				# Most likely an ICMP error from an earlier send
+				self.__free.append(buf)
+				continue
+			with self.__cond:
+				self.__replies.append(memoryview(buf)[:n])
+				self.__cond.notify()
+		self.__wake_r.close()
+		self.__wake_w.close()
+
+"""
+
+Formatted frame cache
+
+"""
+class FrameCache:
+	
+	"""
+	Nearly all traffic is a small set of frames that repeat. The formatted
+	result is held against (cat_cmd, param) so a repeat costs two dict
+	lookups and no allocation. Frequency sets have an open ended parameter
+	space so they are held in a bounded LRU, everything else is held for ever.
+	
+	The cache is not locked. The CAT thread and CATThrd.schedule_ptt(),
+	which formats on the caller's thread, only use it with the CAT thread's
+	lock held.
+	
+	"""
+	
+	def __init__(self, formatter, lru_cmds = (CAT_FREQ_SET,), lru_size = FRAME_CACHE_SIZE):
+		"""
+		Constructor
+		
+		Arguments:
+			formatter	--	callable(cat_cmd, param) returning (r, bytes)
+			lru_cmds	--	commands held in the LRU
+			lru_size	--	maximum entries per LRU command
 			
 		"""
 		
-		if (self.__transport == CAT_SERIAL and self.__port_open) or self.__transport == CAT_UDP:
-			self.__cat_thrd.do_command(cat_cmd, params)
+		self.__formatter = formatter
+		self.__lru_size = lru_size
+		# cat_cmd -> {param: (True, frame)}
+		self.__frames = {}
+		for cat_cmd in lru_cmds:
+			self.__frames[cat_cmd] = OrderedDict()
+		self.__hits = 0
+		self.__misses = 0
 	
-	def get_serial_ports(self):
-		""" Return available serial port names """
-		
-		return self.__ports
+	def format(self, cat_cmd, param):
+		"""
+		Return (r, frame) for the command
 		
-	def __list_serial_ports(self):
-		""" Lists available serial port names """
+		Arguments:
+			cat_cmd	-- command type
+			param	--	command parameters
+			
+		"""
 		
-		self.__ports = []
-		all_ports = []
-		if sys.platform.startswith('win'):
-			all_ports = ['COM%s' % (i + 1) for i in range(20)]
-		elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-			# this excludes your current terminal "/dev/tty"
-			all_ports = glob.glob('/dev/tty[A-Za-z]*')
-		elif sys.platform.startswith('darwin'):
-			all_ports = glob.glob('/dev/tty.*')
-	
-		for port in all_ports:
-			try:
-				s = serial.Serial(port)
-				s.close()
-				self.__ports.append(port)
-			except (OSError, serial.SerialException):
-				pass
-			except Exception:
-				pass
-		#print (self.__ports)
-		return self.__ports
+		frames = self.__frames.get(cat_cmd)
+		if frames != None:
+			result = frames.get(param)
+			if result != None:
+				self.__hits += 1
+				if isinstance(frames, OrderedDict):
+					frames.move_to_end(param)
+				return result
+		self.__misses += 1
+		result = self.__formatter(cat_cmd, param)
+		if result[0]:
+			if frames == None:
+				frames = self.__frames[cat_cmd] = {}
+			frames[param] = result
+			if isinstance(frames, OrderedDict) and len(frames) > self.__lru_size:
+				frames.popitem(last = False)
+		return result
 	
+	def stats(self):
+		""" Return a dict of hits, misses and the number of frames held """
+		
+		return {
+			'hits': self.__hits,
+			'misses': self.__misses,
+			'size': sum(len(frames) for frames in self.__frames.values())
+		}
+
 """
 
-CAT execution thread for all CAT variants.
+Compiled command sets
 
 """
-class CATThrd (threading.Thread):
+class CompiledCommandSet:
 	
-	def __init__(self, variant, command_set, ip, port, transport, device):
-		"""
-		Constructor
-		
-		Arguments
-			variant		--	CAT command set variant
-			command_set	--	command set to use
-			ip			--	UDP enpoint
-			port		--	UDP endpoint
-			transport	--	CAT_UDP | CAT_SERIAL
-			device   	--  an open device for the transport
-		"""
-
-		super(CATThrd, self).__init__()
-		
-		self.__variant = variant
-		self.__command_set = command_set
-		self.__ip = ip
-		self.__port = port
-		self.__transport = transport
-		self.__device = device
-		self.__callback = None
-		
-		# Class vars
-		self.__cat_cls_inst = self.__command_set[CLASS](command_set)
-		self.__q = deque(maxlen=2)
-		# Terminate flag
-		self.__terminate = False
+	"""
+	Immutable, precomputed form of a CAT_COMMAND_SETS entry.
 	
-	def set_callback(self, callback):
+	Each variant class names a subclass in COMMAND_SET which is built once
+	at load into COMPILED_COMMAND_SETS. Frames that never change are held
+	complete as bytes and modes are mapped in both directions, so that
+	formatting and decoding are attribute and dictionary lookups.
+	
+	"""
+	
+	__slots__ = ('parity', 'stop_bits', 'timeout', 'read_sz', 'mode_codes', 'mode_names')
+	
+	def __init__(self, command_set):
 		"""
-		Callback here with responses
+		Constructor
 		
 		Arguments:
-			callback	-- 	the callable
+			command_set	--	an entry from CAT_COMMAND_SETS
 			
 		"""
 		
-		self.__callback = callback
+		self._init(parity = command_set[SERIAL][PARITY],
+			stop_bits = command_set[SERIAL][STOP_BITS],
+			timeout = command_set[SERIAL][TIMEOUT],
+			read_sz = command_set[SERIAL][READ_SZ])
+		# Mode -> code as sent and code as received -> mode
+		codes = {}
+		names = {}
+		for mode, code in command_set[MODES].items():
+			if isinstance(code, int):
+				codes[mode] = code
+				names[code] = mode
+			else:
+				codes[mode] = bytes(code)
+				names[code[0]] = mode
+		self._init(mode_codes = MappingProxyType(codes), mode_names = MappingProxyType(names))
+	
+	def _init(self, **attrs):
+		""" Set attributes, only used while compiling """
 		
-	def terminate(self):
-		""" Asked to terminate the thread """
+		for name, value in attrs.items():
+			object.__setattr__(self, name, value)
+	
+	def __setattr__(self, name, value):
 		
-		self.__terminate = True
-		self.join()
+		raise AttributeError('Compiled command sets are read only')
+
+class YAESUCommandSet (CompiledCommandSet):
 	
-	def do_command(self, cat_cmd, params):
+	""" Compiled FT-817ND command set """
+	
+	__slots__ = ('lock_on', 'lock_off', 'ptt_on', 'ptt_off', 'freq_mode_get', 'set_freq', 'set_mode')
+	
+	def __init__(self, command_set):
 		"""
-		Execute a new CAT command
+		Constructor
 		
 		Arguments:
-			cat_cmd	-- 	from the CAT command enumerations
-			params	--	required parameters for the command
+			command_set	--	command set for the FT-817ND
 			
 		"""
 		
-		# We add the command to a thread-safe Q for execution by the thread
-		# Note we are only interested in the last frequency and the one potentially being executed.
-		# The max_len is therefore set to 2 which discards elements from the opposite end of the q
-		# when the queue is full.
-		self.__q.append((cat_cmd, params))
-				
-	def run(self):
-		
-		""" Thread entry point """
+		super(YAESUCommandSet, self).__init__(command_set)
 		
-		#
-		# Handles all CAT interactions with an external tranceiver
-		#
-		#	Tracking - keep antenna resonance in line with received frequency
-		#	Calibration - automatic setpoint calibration - TBD
-		#
-			
-		while not self.__terminate:
-			try:
-				# Requests are queued
-				while len(self.__q) > 0:
-					# Get the command,
-					cmd, param = self.__q.popleft()
-					# format,
-					(r, cmd_buf) = self.__cat_cls_inst.format_cat_cmd(cmd, param)
-					if r:
-						# and send using the appropriate transport
-						if self.__transport == CAT_UDP:
-							# We assume a response on UDP
-							self.__device.sendto(cmd_buf, (self.__ip, self.__port))
-							data, addr = self.__device.recvfrom(128)
-							# Return data to the caller
-							# Note, this is an async return
-							response = self.__cat_cls_inst.decode_cat_resp(cmd, data)
-							if self.__callback != None: self.__callback(response)
-						elif self.__transport == CAT_SERIAL:
-							# We do not assume a response on Serial
-							self.__device.write(cmd_buf)
-							if self.__cat_cls_inst.is_response(cmd):
-								if self.__command_set[CLASS] == ICOM:
-									data = bytearray(30)
-									n = 0
-									while True:
-										ch = self.__device.read()
-										data[n:n+1] = ch
-										# There will be a terminator at the end of the OK or NG frame
-										# skip that and then if there is no data we will timeout and
-										# an error response returned from decode.
-										if ch == b'\xfd':
-											break
-										n += 1
-								else:
-									data = self.__device.read(self.__command_set[SERIAL][READ_SZ])
-								# Return data to the caller
-								# Note, this is an async return
-								response = self.__cat_cls_inst.decode_cat_resp(CAT_COMMAND_SETS[self.__variant], cmd, data)
-								if self.__callback != None: self.__callback(response)
-							else:
-								# There may be an ack/nak response or a reflected command
-								data = bytearray(30)
-								n = 0
-								while True:
-									ch = self.__device.read()
-									data[n:n+1] = ch
-									# There will be a terminator at the end of the OK or NG frame
-									# skip that and then if there is no data we will timeout and
-									# an error response returned from decode.
-									if ch == b'\xfd':
-										break
-									n += 1
-								response = self.__cat_cls_inst.ack_nak(CAT_COMMAND_SETS[self.__variant], data)
-								if self.__callback != None: self.__callback(response)
-				sleep(0.1)
-			except Exception as e:
-				# Oops
-				if self.__callback != None: self.__callback((False, 'ERROR [%s]' % (str(e))))
+		commands = command_set[COMMANDS]
+		# Commands are 4 parameter bytes followed by the command byte
+		self._init(lock_on = bytes([0x00, 0x00, 0x00, 0x00, commands[LOCK_ON]]),
+			lock_off = bytes([0x00, 0x00, 0x00, 0x00, commands[LOCK_OFF]]),
+			ptt_on = bytes([0x00, 0x00, 0x00, 0x00, commands[PTT_ON]]),
+			ptt_off = bytes([0x00, 0x00, 0x00, 0x00, commands[PTT_OFF]]),
+			freq_mode_get = bytes([0x00, 0x00, 0x00, 0x00, commands[FREQ_MODE_GET]]),
+			set_freq = commands[SET_FREQ],
+			set_mode = commands[SET_MODE])
 
 """
 
@@ -373,6 +2272,9 @@ class YAESU:
 	
 	"""
 	
+	# Compiled form of our command set
+	COMMAND_SET = YAESUCommandSet
+	
 	def __init__(self, command_set):
 		"""
 		Constructor
@@ -383,20 +2285,20 @@ class YAESU:
 		"""
 		
 		self.__command_set = command_set
-		
-		# Create the dispatch table
-		commands = command_set[COMMANDS]
-		self.__dispatch = {
-			REFERENCE: CAT_COMMAND_SETS[FT_817ND],
-			MAP: {
-				CAT_LOCK: [self.__lock, False],
-				CAT_PTT: [self.__ptt, False],
-				CAT_FREQ_SET: [self.__freq_set, False],
-				CAT_MODE_SET: [self.__mode_set, False],
-				CAT_FREQ_GET: [self.__freq_mode_get, True],
-				CAT_MODE_GET: [self.__freq_mode_get, True],
-			}
+		self.__cs = COMPILED_COMMAND_SETS[FT_817ND]
+		
+		# Create the dispatch table, command -> (formatter, response expected)
+		self.__map = {
+			CAT_LOCK: (self.__lock, False),
+			CAT_PTT: (self.__ptt, False),
+			CAT_FREQ_SET: (self.__freq_set, False),
+			CAT_MODE_SET: (self.__mode_set, False),
+			CAT_FREQ_GET: (self.__freq_mode_get, True),
+			CAT_MODE_GET: (self.__freq_mode_get, True),
+			CAT_FREQ_MODE_GET: (self.__freq_mode_get, True),
 		}
+		# Formatted frames
+		self.__cache = FrameCache(self.__format)
 		
 	def format_cat_cmd(self, cat_cmd, param):
 		"""
@@ -408,44 +2310,51 @@ class YAESU:
 			
 		"""
 		
-		if not cat_cmd in self.__dispatch[MAP]:
+		return self.__cache.format(cat_cmd, param)
+	
+	def cache_stats(self):
+		""" Return the frame cache hit/miss counters """
+		
+		return self.__cache.stats()
+	
+	def __format(self, cat_cmd, param):
+		"""
+		Format the command bytes, called by the cache on a miss
+		
+		Arguments:
+			cat_cmd	-- command type
+			param	--	command parameters
+			
+		"""
+		
+		entry = self.__map.get(cat_cmd)
+		if entry == None:
 			return False, None
 		
 		# Format command
-		return self.__dispatch[MAP][cat_cmd][0](self.__dispatch[REFERENCE], param)
+		return entry[0](param)
 	
 	def decode_cat_resp(self, lookup, cat_cmd, data):
 		"""
 		Decode and return a tuple according to command type
 		
 		Arguments:
+			lookup	--	not used, the instance holds the compiled command set
 			cat_cmd	-- command type
 			data	--	the response bytes
 			
 		"""
 		 
 		if cat_cmd == CAT_FREQ_GET:
-			# Data 1-4 is freq MSB first
+			# Data 1-4 is freq MSB first in 10 Hz units
 			# 01, 42, 34, 56, [ 01 ] = 14.23456 MHz
-			MHz_100 = ((data[0] & 0xF0) >> 4) * 100000000
-			MHz_10 = (data[0] & 0x0F) * 10000000
-			MHz_1 = ((data[1] & 0xF0) >> 4) * 1000000
-			KHz_100 = (data[1] & 0x0F) * 100000
-			KHz_10 = ((data[2] & 0xF0) >> 4) * 10000
-			KHz_1 = (data[2] & 0x0F) * 1000
-			Hz_100 = ((data[3] & 0xF0) >> 4) * 100
-			Hz_10 = (data[3] & 0x0F) * 10
-			Hz = MHz_100 + MHz_10 + MHz_1 + KHz_100 + KHz_10 + KHz_1 + Hz_100 + Hz_10
-			return True, Hz
+			return True, bcd.decode_be(data, 0, 4) * 10
 		elif cat_cmd == CAT_MODE_GET:
 			# Data 4 is mode
-			mode_id = data[4]
-			mode_str = ''
-			for key, value in lookup[MODES].items():
-				if value == mode_id:
-					mode_str = key
-					break
-			return True, mode_str
+			return True, self.__cs.mode_names.get(data[4], '')
+		elif cat_cmd == CAT_FREQ_MODE_GET:
+			# Both from the one response
+			return True, (bcd.decode_be(data, 0, 4) * 10, self.__cs.mode_names.get(data[4], ''))
 		else:
 			return False, None
 	
@@ -469,78 +2378,192 @@ class YAESU:
 			cmd	--	command to test
 		"""
 		
-		return self.__dispatch[MAP][cmd][1]
+		return self.__map[cmd][1]
+	
+	def supports(self, cmd):
+		"""
+		True if the command is implemented
+		
+		Arguments:
+			cmd	--	command to test
+		"""
+		
+		return cmd in self.__map
+	
+	def confirms(self, cmd):
+		"""
+		True if a successful response shows the radio acted on the command
+		
+		Arguments:
+			cmd	--	command to test
+		"""
+		
+		# Sets get no answer at all, only a get reads the radio
+		return self.is_response(cmd)
+	
+	def match_reply(self, cmd, cmd_buf, data):
+		"""
+		True if a UDP reply could be the answer to a command
+		
+		Arguments:
+			cmd		--	command type
+			cmd_buf	--	the command bytes sent
+			data	--	the reply
+		"""
+		
+		# Replies carry nothing to identify them so they are matched in order
+		return True
+	
+	def set_freq_hz(self, freq):
+		"""
+		Return the frequency in Hz the radio is on after a frequency set
+		
+		Arguments:
+			freq	--	Frequency in MHz as given to CAT_FREQ_SET
+		"""
+		
+		# Set in 10 Hz units
+		return int(round(freq*100000)) * 10
+
+	def format_freq_batch(self, freqs):
+		"""
+		Format a frequency set command for each of many frequencies
+		
+		Arguments:
+			freqs	--	array like of frequencies in MHz
+		
+		Returns (buffer, offsets) where frame i is buffer[offsets[i]:offsets[i+1]].
+		Requires numpy.
+		
+		"""
+		
+		import numpy as np
+		
+		units = np.rint(np.asarray(freqs, dtype=np.float64) * 100000).astype(np.int64)
+		frames = np.empty((len(units), 5), dtype=np.uint8)
+		frames[:, 0:4] = bcd.encode_be_array(units, 4)
+		frames[:, 4] = self.__cs.set_freq
+		return frames.tobytes(), np.arange(len(units) + 1, dtype=np.int64) * 5
+	
+	def decode_freq_batch(self, data, offsets = None):
+		"""
+		Decode the frequency from each of many frequency/mode responses
+		
+		Arguments:
+			data	--	bytes like, the responses
+			offsets	--	start of each response in data, default back to back 5 byte responses
+		
+		Returns an int64 array of frequencies in Hz.
+		Requires numpy.
+		
+		"""
+		
+		import numpy as np
+		
+		buf = np.frombuffer(data, dtype=np.uint8)
+		if offsets is None:
+			records = buf[:len(buf) - len(buf) % 5].reshape(-1, 5)[:, 0:4]
+		else:
+			records = buf[np.asarray(offsets, dtype=np.int64)[:, None] + np.arange(4)]
+		return bcd.decode_be_array(records) * 10
 	
-	def __lock(self, lookup, state):
+	def __lock(self, state):
 		"""
 		Toggle Lock on/off
 		
 		Arguments:
-			lookup	--	ref to the command lookup
 			state	--	True if Lock on
 			
 		"""
 		
 		if state:
-			lock = lookup[COMMANDS][CAT_LOCK][1]
+			return True, self.__cs.lock_on
 		else:
-			lock = lookup[COMMANDS][CAT_LOCK][2]
-		return True, bytearray([0x00, 0x00, 0x00, 0x00, lock])
+			return True, self.__cs.lock_off
 
-	def __ptt(self, lookup, state):
+	def __ptt(self, state):
 		"""
 		Toggle PTT on/off
 		
 		Arguments:
-			lookup	--	ref to the command lookup
 			state	--	True if PTT on
 			
 		"""
 		
 		if state:
-			ptt = lookup[COMMANDS][CAT_PTT][1]
+			return True, self.__cs.ptt_on
 		else:
-			ptt = lookup[COMMANDS][CAT_PTT][2]
-		return True, bytearray([0x00, 0x00, 0x00, 0x00, ptt])
+			return True, self.__cs.ptt_off
 	
-	def __mode_set(self, lookup, mode):
+	def __mode_set(self, mode):
 		"""
 		Change mode
 		
 		Arguments:
-			lookup	--	ref to the command lookup
 			mode	--	Mode to set
 			
 		"""
 		
-		return True, bytearray([lookup[MODES][mode], 0x00, 0x00, 0x00, lookup[COMMANDS][SET_MODE]])
+		return True, bytes([self.__cs.mode_codes[mode], 0x00, 0x00, 0x00, self.__cs.set_mode])
 		
-	def __freq_set(self, lookup, freq):
+	def __freq_set(self, freq):
 		"""
 		Change frequency
 		
 		Arguments:
-			lookup	--	ref to the command lookup
 			freq	--	Frequency in MHz
 			
 		"""
 		
 		# Frequency is a float in MHz like 14.100000
-		# Make a hex prefixed string using 5 significant digits
-		fs = str(int(freq*100000))
-		fs = fs.zfill(8)
-		b=bytearray.fromhex(fs)
-		return True, bytearray([b[0], b[1], b[2], b[3], lookup[COMMANDS][SET_FREQ]])
+		# The radio wants 8 BCD digits in 10 Hz units, MSB first
+		return True, bcd.encode_be(int(round(freq*100000)), 4) + bytes([self.__cs.set_freq])
 		
-	def __freq_mode_get(self, lookup, dummy):
+	def __freq_mode_get(self, dummy):
 		"""
 		Get the frequency and mode
 		
 		Arguments:
+			dummy	--	
+			
+		"""
+		
+		return True, self.__cs.freq_mode_get
+
+class ICOMCommandSet (CompiledCommandSet):
+	
+	""" Compiled IC7100 command set """
+	
+	__slots__ = ('lock_on', 'lock_off', 'ptt_on', 'ptt_off', 'freq_get', 'mode_get', 'freq_set_prefix', 'mode_set_prefix', 'freq_cmd', 'mode_cmd', 'ack', 'nak')
+	
+	def __init__(self, command_set):
+		"""
+		Constructor
+		
+		Arguments:
+			command_set	--	command set for the IC7100
 			
 		"""
 		
-		return True, bytearray([0x00, 0x00, 0x00, 0x00, lookup[COMMANDS][FREQ_MODE_GET]])
+		super(ICOMCommandSet, self).__init__(command_set)
+		
+		c = command_set[COMMANDS]
+		lock = c[LOCK_CMD] + c[LOCK_SUB]
+		ptt = c[TRANCEIVE_STATUS_CMD] + c[TRANCEIVE_STATUS_SUB]
+		self._init(lock_on = build_frame(lock + c[LOCK_ON]),
+			lock_off = build_frame(lock + c[LOCK_OFF]),
+			ptt_on = build_frame(ptt + c[PTT_ON]),
+			ptt_off = build_frame(ptt + c[PTT_OFF]),
+			freq_get = build_frame(c[GET_FREQ_CMD] + c[GET_FREQ_SUB]),
+			mode_get = build_frame(c[GET_MODE_CMD] + c[GET_MODE_SUB]),
+			# Variable frames are prefix + data + EOM
+			freq_set_prefix = build_frame(c[SET_FREQ_CMD] + c[SET_FREQ_SUB])[:-1],
+			mode_set_prefix = build_frame(c[SET_MODE_CMD] + c[SET_MODE_SUB])[:-1],
+			# Command numbers also used by the radio for transceive frames
+			freq_cmd = c[SET_FREQ_CMD][0],
+			mode_cmd = c[SET_MODE_CMD][0],
+			ack = command_set[RESPONSES][ACK],
+			nak = command_set[RESPONSES][NAK])
 
 """
 
@@ -588,30 +2611,32 @@ class ICOM:
 	
 	"""
 	
+	# Compiled form of our command set
+	COMMAND_SET = ICOMCommandSet
+	
 	def __init__(self, command_set):
 		"""
 		Constructor
 		
 		Arguments:
-			command_set	--	command set for the FT-817ND
+			command_set	--	command set for the IC7100
 			
 		"""
 		
 		self.__command_set = command_set
-		
-		# Create the dispatch table
-		commands = command_set[COMMANDS]
-		self.__dispatch = {
-			REFERENCE: CAT_COMMAND_SETS[IC7100],
-			MAP: {
-				CAT_LOCK: [self.__lock, False],
-				CAT_PTT: [self.__ptt, False],
-				CAT_FREQ_SET: [self.__freq_set, False],
-				CAT_MODE_SET: [self.__mode_set, False],
-				CAT_FREQ_GET: [self.__freq_get, True],
-				CAT_MODE_GET: [self.__mode_get, True]
-			}
+		self.__cs = COMPILED_COMMAND_SETS[IC7100]
+		
+		# Create the dispatch table, command -> (formatter, response expected)
+		self.__map = {
+			CAT_LOCK: (self.__lock, False),
+			CAT_PTT: (self.__ptt, False),
+			CAT_FREQ_SET: (self.__freq_set, False),
+			CAT_MODE_SET: (self.__mode_set, False),
+			CAT_FREQ_GET: (self.__freq_get, True),
+			CAT_MODE_GET: (self.__mode_get, True)
 		}
+		# Formatted frames
+		self.__cache = FrameCache(self.__format)
 		
 	def format_cat_cmd(self, cat_cmd, param):
 		"""
@@ -623,27 +2648,46 @@ class ICOM:
 			
 		"""
 		
-		if not cat_cmd in self.__dispatch[MAP]:
+		return self.__cache.format(cat_cmd, param)
+	
+	def cache_stats(self):
+		""" Return the frame cache hit/miss counters """
+		
+		return self.__cache.stats()
+	
+	def __format(self, cat_cmd, param):
+		"""
+		Format the command bytes, called by the cache on a miss
+		
+		Arguments:
+			cat_cmd	-- command type
+			param	--	command parameters
+			
+		"""
+		
+		entry = self.__map.get(cat_cmd)
+		if entry == None:
 			return False, None
 		
 		# Format command
-		return self.__dispatch[MAP][cat_cmd][0](self.__dispatch[REFERENCE], param)
+		return entry[0](param)
 	
 	def decode_cat_resp(self, lookup, cat_cmd, data):
 		"""
 		Decode and return a tuple according to command type
 		
 		Arguments:
+			lookup	--	not used, the instance holds the compiled command set
 			cat_cmd	-- command type
 			data	--	the response bytes
 			
 		"""
 		
-		# Data consists of an OK or NG message followed by the response if OK
+		# Data is the response frame, an NG message if the command failed
 		RESPONSE_CODE = 4
-		DATA_START = 11
-		DATA_END = 15
-		if data[RESPONSE_CODE] == lookup[RESPONSES][NAK]:
+		DATA_START = 5
+		DATA_END = 9
+		if data[RESPONSE_CODE] == self.__cs.nak:
 			return False, None
 		if cat_cmd == CAT_FREQ_GET:
 			# The data is in BCD format in 10 fields (0-9) - 5 bytes
@@ -658,32 +2702,36 @@ class ICOM:
 			# 3		1		10MHZ
 			# 4		0		100MHz
 			# 4		1		1000MHz (always zero)
-			
-			MHz_1000 = ((data[DATA_END - 0] & 0xF0) >> 4) * 1000000000
-			MHz_100 = (data[DATA_END - 0] & 0x0F) * 100000000
-			MHz_10 = ((data[DATA_END - 1] & 0xF0) >> 4) * 10000000
-			MHz_1 = (data[DATA_END - 1] & 0x0F) * 1000000
-			KHz_100 = ((data[DATA_END - 2] & 0xF0) >> 4) * 100000
-			KHz_10 = (data[DATA_END - 2] & 0x0F) * 10000
-			KHz_1 = ((data[DATA_END - 3] & 0xF0) >> 4) * 1000
-			Hz_100 = (data[DATA_END - 3] & 0x0F) * 100
-			Hz_10 = ((data[DATA_END - 4] & 0x0F) >> 4) * 10
-			Hz_1 = data[DATA_END - 4] & 0xF0
-			Hz = MHz_1000 + MHz_100 + MHz_10 + MHz_1 + KHz_100 + KHz_10 + KHz_1 + Hz_100 + Hz_10 + Hz_1
-			return True, Hz
+			# where nibble 1 is the high nibble, i.e. little endian BCD
+			return True, bcd.decode_le(data, DATA_START, DATA_END - DATA_START + 1)
 		elif cat_cmd == CAT_MODE_GET:
 			# Data byte 0 - mode
 			# Data byte 1 - filter
-			mode_id = data[DATA_START]
-			mode_str = ''
-			for key, value in lookup[MODES].items():
-				if value == mode_id:
-					mode_str = key
-					break
-			return True, mode_str
+			return True, self.__cs.mode_names.get(data[DATA_START], '')
 		else:
 			# Not expecting anything else
 			return False, None
+	
+	def decode_transceive(self, lookup, frame):
+		"""
+		Decode an unsolicited frame sent when the radio changes
+		
+		Arguments:
+			lookup	--	not used, the instance holds the compiled command set
+			frame	--	the CI-V frame
+		
+		Returns (CAT_EVT_FREQ, Hz), (CAT_EVT_MODE, mode) or None
+		
+		"""
+		
+		# Transceive frames have the same data area as the get responses
+		if frame[CMD] == self.__cs.freq_cmd:
+			r, freq = self.decode_cat_resp(lookup, CAT_FREQ_GET, frame)
+			return CAT_EVT_FREQ, freq
+		elif frame[CMD] == self.__cs.mode_cmd:
+			r, mode = self.decode_cat_resp(lookup, CAT_MODE_GET, frame)
+			return CAT_EVT_MODE, mode
+		return None
 
 	def ack_nak(self, lookup, data):
 		"""
@@ -696,7 +2744,7 @@ class ICOM:
 		
 		if len(data) > 0:
 			if len(data) == 6:
-				if data[4] == lookup[RESPONSES][ACK]:
+				if data[4] == self.__cs.ack:
 					return True, None
 				else:
 					return False, None
@@ -714,76 +2762,153 @@ class ICOM:
 			cmd	--	command to test
 		"""
 		
-		return self.__dispatch[MAP][cmd][1]
+		return self.__map[cmd][1]
+	
+	def supports(self, cmd):
+		"""
+		True if the command is implemented
+		
+		Arguments:
+			cmd	--	command to test
+		"""
+		
+		return cmd in self.__map
+	
+	def confirms(self, cmd):
+		"""
+		True if a successful response shows the radio acted on the command
+		
+		Arguments:
+			cmd	--	command to test
+		"""
+		
+		# Sets are answered with OK or NG
+		return cmd in self.__map
+	
+	def match_reply(self, cmd, cmd_buf, data):
+		"""
+		True if a UDP reply could be the answer to a command
+		
+		Arguments:
+			cmd		--	command type
+			cmd_buf	--	the command bytes sent
+			data	--	the reply
+		"""
+		
+		if len(data) < MIN_FRAME or data[FROM_ADDR] == CONTROLLER:
+			# Not a frame or our own echo
+			return False
+		if data[CMD] == self.__cs.nak:
+			return True
+		if self.is_response(cmd):
+			# Data comes back under our command number
+			return data[CMD] == cmd_buf[CMD]
+		return data[CMD] == self.__cs.ack
+	
+	def set_freq_hz(self, freq):
+		"""
+		Return the frequency in Hz the radio is on after a frequency set
+		
+		Arguments:
+			freq	--	Frequency in MHz as given to CAT_FREQ_SET
+		"""
+		
+		return int(round(freq*1000000))
+
+	def format_freq_batch(self, freqs):
+		"""
+		Format a frequency set command for each of many frequencies
+		
+		Arguments:
+			freqs	--	array like of frequencies in MHz
+		
+		Returns (buffer, offsets) where frame i is buffer[offsets[i]:offsets[i+1]].
+		Requires numpy.
+		
+		"""
+		
+		import numpy as np
+		
+		hz = np.rint(np.asarray(freqs, dtype=np.float64) * 1000000).astype(np.int64)
+		# Every frame is the same apart from the BCD data area
+		template = self.__cs.freq_set_prefix + bytes(5) + bytes([EOM])
+		start = len(self.__cs.freq_set_prefix)
+		frames = np.empty((len(hz), len(template)), dtype=np.uint8)
+		frames[:] = np.frombuffer(template, dtype=np.uint8)
+		frames[:, start:start + 5] = bcd.encode_le_array(hz, 5)
+		return frames.tobytes(), np.arange(len(hz) + 1, dtype=np.int64) * len(template)
+	
+	def decode_freq_batch(self, data, offsets = None):
+		"""
+		Decode the frequency from each of many frequency responses
+		
+		Arguments:
+			data	--	bytes like, the response frames
+			offsets	--	start of each frame in data, default back to back 11 byte frames
+		
+		Returns an int64 array of frequencies in Hz.
+		Requires numpy.
+		
+		"""
+		
+		import numpy as np
+		
+		# Each frame is FE FE E0 88 03 d0 d1 d2 d3 d4 FD
+		buf = np.frombuffer(data, dtype=np.uint8)
+		if offsets is None:
+			records = buf[:len(buf) - len(buf) % 11].reshape(-1, 11)[:, 5:10]
+		else:
+			records = buf[np.asarray(offsets, dtype=np.int64)[:, None] + np.arange(5, 10)]
+		return bcd.decode_le_array(records)
 	
-	def __lock(self, lookup, state):
+	def __lock(self, state):
 		"""
 		Toggle Lock on/off
 		
 		Arguments:
-			lookup	--	ref to the command lookup
 			state	--	True if Lock on
 			
 		"""
 		
-		cmd = lookup[COMMANDS][LOCK_CMD]
-		sub_cmd = lookup[COMMANDS][LOCK_SUB]
 		if state:
-			# Set lock on
-			data = lookup[COMMANDS][LOCK_ON]
+			return True, self.__cs.lock_on
 		else:
-			data = lookup[COMMANDS][LOCK_OFF]
-			
-		return self.__complete_build(cmd, sub_cmd, data)
+			return True, self.__cs.lock_off
 		
-	def __ptt(self, lookup, state):
+	def __ptt(self, state):
 		"""
 		Toggle PTT on/off
 		
 		Arguments:
-			lookup	--	ref to the command lookup
 			state	--	True if PTT on
 			
 		"""
 		
-		cmd = lookup[COMMANDS][TRANCEIVE_STATUS_CMD]
-		sub_cmd = lookup[COMMANDS][TRANCEIVE_STATUS_SUB]
 		if state:
-			# Set PTT on
-			data = lookup[COMMANDS][PTT_ON]
+			return True, self.__cs.ptt_on
 		else:
-			data = lookup[COMMANDS][PTT_OFF]
-			
-		return self.__complete_build(cmd, sub_cmd, data)
+			return True, self.__cs.ptt_off
 	
-	def __mode_set(self, lookup, mode):
+	def __mode_set(self, mode):
 		"""
 		Change mode
 		
 		Arguments:
-			lookup	--	ref to the command lookup
 			mode	--	Mode to set
 			
 		"""
 		
-		cmd = lookup[COMMANDS][SET_MODE_CMD]
-		sub_cmd = lookup[COMMANDS][SET_MODE_SUB]
-		data = lookup[MODES][mode]
-		
-		return self.__complete_build(cmd, sub_cmd, data)
+		return True, self.__cs.mode_set_prefix + self.__cs.mode_codes[mode] + bytes([EOM])
 		
-	def __freq_set(self, lookup, freq):
+	def __freq_set(self, freq):
 		"""
 		Change frequency
 		
 		Arguments:
-			lookup	--	ref to the command lookup
 			freq	--	Frequency in MHz
 			
 		"""
 		
-		cmd = lookup[COMMANDS][SET_FREQ_CMD]
-		sub_cmd = lookup[COMMANDS][SET_FREQ_SUB]			
 		# Frequency is a float in MHz like 14.100000
 		# The data is required in BCD format in 10 fields (0-9) - 5 bytes
 		# Byte 	Nibble 	Digit
@@ -797,77 +2922,30 @@ class ICOM:
 		# 3		1		10MHZ
 		# 4		0		100MHz
 		# 4		1		1000MHz (always zero)
+		# where nibble 1 is the high nibble, i.e. little endian BCD
+		return True, self.__cs.freq_set_prefix + bcd.encode_le(int(round(freq*1000000)), 5) + bytes([EOM])
 		
-		# Make a string of the frequency in Hz
-		fs = str(int(freq*1000000))
-		fs = fs.zfill(10)
-		# Make an array to store the result
-		data = bytearray(5)
-		# Iterate through the string
-		byte = 4
-		nibble = 0
-		for c in fs:
-			if nibble == 0:
-				data[byte] = ((data[byte] | int(c)) << 4) & 0xF0
-				nibble = 1
-			else:
-				data[byte] = data[byte] | (int(c) & 0x0F)
-				nibble = 0
-				byte -= 1
-		return self.__complete_build(cmd, sub_cmd, data)
-		
-	def __freq_get(self, lookup, dummy):
+	def __freq_get(self, dummy):
 		"""
 		Get the current frequency
 		
 		Arguments:
-			lookup	--	ref to the command lookup
 			dummy	--	
 			
 		"""
 		
-		cmd = lookup[COMMANDS][GET_FREQ_CMD]
-		sub_cmd = lookup[COMMANDS][GET_FREQ_SUB]
-		data = bytearray([])
-		
-		return self.__complete_build(cmd, sub_cmd, data)
+		return True, self.__cs.freq_get
 	
-	def __mode_get(self, lookup, dummy):
+	def __mode_get(self, dummy):
 		"""
 		Get the current mode
 		
 		Arguments:
-			lookup	--	ref to the command lookup
 			dummy	--	
 			
 		"""
 		
-		cmd = lookup[COMMANDS][GET_MODE_CMD]
-		sub_cmd = lookup[COMMANDS][GET_MODE_SUB]
-		data = bytearray([])
-		
-		return self.__complete_build(cmd, sub_cmd, data)
-	
-	def __complete_build(self, cmd, sub_cmd, data):
-		"""
-		Finish building command
-		
-		Arguments:
-			cmd			--	command field
-			sub_cmd		--	sub-command field
-			data		--	data field
-			
-		"""
-		
-		# Do header
-		b = bytearray([0xFE, 0xFE, 0x88, 0xE0])
-		# Add the byte arrays for the data
-		b += cmd[:]
-		b += sub_cmd[:]
-		b += data[:]
-		b += bytearray([0xFD, ])
-			
-		return True, b
+		return True, self.__cs.mode_get
 				
 # ============================================================================
 # Command sets
@@ -875,10 +2953,12 @@ CAT_COMMAND_SETS = {
 	FT_817ND: {
 		CLASS: YAESU,
 		SERIAL: {
-			PARITY: serial.PARITY_NONE,
-			STOP_BITS: serial.STOPBITS_ONE,
+			PARITY: PARITY_NONE,
+			STOP_BITS: STOPBITS_ONE,
 			TIMEOUT: 2,
-			READ_SZ: 5
+			READ_SZ: 5,
+			# The FT-817 has no flow control and drops commands that arrive too fast
+			GAP: 0.005
 		},
 		COMMANDS: {
 			LOCK_ON: 0x00,
@@ -903,10 +2983,11 @@ CAT_COMMAND_SETS = {
 	IC7100: {
 		CLASS: ICOM,
 		SERIAL: {
-			PARITY: serial.PARITY_NONE,
-			STOP_BITS: serial.STOPBITS_ONE,
+			PARITY: PARITY_NONE,
+			STOP_BITS: STOPBITS_ONE,
 			TIMEOUT: 5,
-			READ_SZ: 17
+			READ_SZ: 17,
+			GAP: 0.0
 		},
 		COMMANDS: {
 			LOCK_CMD: bytearray([0x1A, ]),
@@ -945,6 +3026,9 @@ CAT_COMMAND_SETS = {
 	}
 }
 
+# Compiled once at load, see CompiledCommandSet
+COMPILED_COMMAND_SETS = {variant: command_set[CLASS].COMMAND_SET(command_set) for variant, command_set in CAT_COMMAND_SETS.items()}
+
 #======================================================================================================================
 # Testing code
 
@@ -975,21 +3059,16 @@ def main():
 		cat = CAT(IC7100, CAT_SETTINGS)
 		cat.set_callback(callback)
 		cat.start_thrd()
-		#cat.do_command(CAT_FREQ_SET, 3.7)
-		#sleep(1)
-		#cat.do_command(CAT_FREQ_GET)
-		#sleep(1)
-		#cat.do_command(CAT_MODE_SET, MODE_AM)
-		#sleep(1)
-		#cat.do_command(CAT_MODE_GET)
-		#sleep(1)
-		#cat.do_command(CAT_LOCK, False)
-		#sleep(1)
-		cat.do_command(CAT_PTT, True)
-		sleep(5.0)
-		cat.do_command(CAT_PTT, False)
+		# Each command returns a Future so we can wait for just the ones we need
+		#print ('Freq set ', cat.do_command(CAT_FREQ_SET, 3.7).result(10))
+		#print ('Freq get ', cat.do_command(CAT_FREQ_GET).result(10))
+		#print ('Mode set ', cat.do_command(CAT_MODE_SET, MODE_AM).result(10))
+		#print ('Mode get ', cat.do_command(CAT_MODE_GET).result(10))
+		#print ('Lock ', cat.do_command(CAT_LOCK, False).result(10))
+		print ('PTT on ', cat.do_command(CAT_PTT, True).result(10))
 		sleep(5.0)
-		#cat.do_command(CAT_LOCK, True)
+		print ('PTT off ', cat.do_command(CAT_PTT, False).result(10))
+		#print ('Lock ', cat.do_command(CAT_LOCK, True).result(10))
 		cat.terminate()
 		
 	except Exception as e:
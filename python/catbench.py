@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# catbench.py
+#
+# CAT performance measurements
+#
+# Copyright (C) 2015 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os, sys
+import argparse
+import contextlib
+import json
+import platform
+import subprocess
+import threading
+from time import perf_counter, time
+import traceback
+
+# Application imports
+from commondefs import *
+from civ import *
+from cat import CAT, CAT_COMMAND_SETS, COMPILED_COMMAND_SETS, ICOMCommandSet
+from rigemu import RigEmulator
+import bcd
+
+"""
+
+Measures the CAT hot path and prints the results as JSON so that runs on
+different revisions can be compared.
+
+	codec		--	format_cat_cmd, decode_cat_resp and ack_nak calls per second
+					for every variant in CAT_COMMAND_SETS
+	loopback	--	do_command to callback latency percentiles against the
+					rig emulator on a pseudo terminal and on a local UDP port
+
+Run as:
+	python catbench.py [-o results.json] [-n iterations] [-s samples] [-b baud]
+
+"""
+
+# Defaults
+ITERATIONS = 20000
+REPEAT = 5
+SAMPLES = 500
+BAUD = 19200
+PERCENTILES = (50, 90, 99)
+
+# Commands timed end to end and their parameters
+LOOPBACK_COMMANDS = ((CAT_FREQ_SET, 7.0), (CAT_FREQ_GET, None), (CAT_MODE_GET, None), (CAT_PTT, False))
+
+def time_call(fn, args, iterations, repeat = REPEAT):
+	"""
+	Return the call rate of fn(*args), best of repeat runs
+
+	Arguments:
+		fn			--	the callable
+		args		--	list of argument tuples, used in turn
+		iterations	--	calls per run
+		repeat		--	runs
+
+	"""
+
+	n = len(args)
+	best = None
+	for r in range(repeat):
+		start = perf_counter()
+		for i in range(iterations):
+			fn(*args[i % n])
+		elapsed = perf_counter() - start
+		if best == None or elapsed < best:
+			best = elapsed
+	return {'iterations': iterations, 'ns_per_op': best * 1e9 / iterations, 'ops_per_sec': iterations / best}
+
+def percentiles(samples):
+	"""
+	Return summary statistics in microseconds
+
+	Arguments:
+		samples	--	latencies in seconds
+
+	"""
+
+	samples = sorted(samples)
+	n = len(samples)
+	if n == 0:
+		return {'samples': 0}
+	result = {'samples': n, 'mean_us': sum(samples) * 1e6 / n, 'min_us': samples[0] * 1e6, 'max_us': samples[-1] * 1e6}
+	for p in PERCENTILES:
+		# Nearest rank
+		result['p%d_us' % p] = samples[min(n - 1, max(0, (p * n + 99) // 100 - 1))] * 1e6
+	return result
+
+def sample_responses(variant):
+	"""
+	Return {cat_cmd: response bytes} as the radio would send them and the ack
+
+	Arguments:
+		variant	--	CAT variant
+
+	"""
+
+	cs = COMPILED_COMMAND_SETS[variant]
+	freq = 14234560
+	mode = MODE_USB
+	if isinstance(cs, ICOMCommandSet):
+		responses = {
+			CAT_FREQ_GET: build_frame(cs.freq_get[CMD:-1] + bcd.encode_le(freq, 5), to = CONTROLLER, frm = RIG),
+			CAT_MODE_GET: build_frame(cs.mode_get[CMD:-1] + cs.mode_codes[mode] + bytes([0x01]), to = CONTROLLER, frm = RIG),
+		}
+		ack = build_frame([cs.ack], to = CONTROLLER, frm = RIG)
+	else:
+		data = bcd.encode_be(freq // 10, 4) + bytes([cs.mode_codes[mode]])
+		responses = {CAT_FREQ_GET: data, CAT_MODE_GET: data, CAT_FREQ_MODE_GET: data}
+		ack = bytes()
+	return responses, ack
+
+def bench_codec(iterations):
+	""" Return the codec rates for each variant """
+
+	results = {}
+	for variant, command_set in CAT_COMMAND_SETS.items():
+		inst = command_set[CLASS](command_set)
+		r = {}
+		# Formatting, frequency sets both from the cache and not
+		repeated = [(CAT_FREQ_SET, 7.0 + i * 0.001) for i in range(16)]
+		unique = [(CAT_FREQ_SET, 1.0 + i * 0.00001) for i in range(iterations)]
+		r['format_freq_set_cached'] = time_call(inst.format_cat_cmd, repeated, iterations)
+		r['format_freq_set_uncached'] = time_call(inst.format_cat_cmd, unique, iterations, 1)
+		r['format_mode_set'] = time_call(inst.format_cat_cmd, [(CAT_MODE_SET, MODE_USB)], iterations)
+		r['format_ptt'] = time_call(inst.format_cat_cmd, [(CAT_PTT, True), (CAT_PTT, False)], iterations)
+		for cat_cmd in (CAT_FREQ_GET, CAT_MODE_GET, CAT_FREQ_MODE_GET):
+			if inst.supports(cat_cmd):
+				r['format_' + cat_cmd] = time_call(inst.format_cat_cmd, [(cat_cmd, None)], iterations)
+		# Decoding
+		responses, ack = sample_responses(variant)
+		for cat_cmd, data in responses.items():
+			r['decode_' + cat_cmd] = time_call(inst.decode_cat_resp, [(command_set, cat_cmd, data)], iterations)
+			r['decode_view_' + cat_cmd] = time_call(inst.decode_cat_resp, [(command_set, cat_cmd, memoryview(data))], iterations)
+		r['ack_nak'] = time_call(inst.ack_nak, [(command_set, ack)], iterations)
+		results[variant] = r
+	return results
+
+def bench_loopback(variant, transport, samples, baud):
+	"""
+	Return the do_command to callback latency for each command
+
+	Arguments:
+		variant		--	CAT variant
+		transport	--	CAT_SERIAL | CAT_UDP
+		samples		--	commands of each type to time
+		baud		--	serial baud rate, CAT paces commands to this
+
+	"""
+
+	rig = RigEmulator(variant, transport)
+	rig.start()
+	port = rig.get_port()
+	if transport == CAT_SERIAL:
+		settings = {NETWORK: [None, None], SERIAL: [port, baud], SELECT: CAT_SERIAL}
+	else:
+		settings = {NETWORK: [port[0], port[1]], SERIAL: [None, None], SELECT: CAT_UDP}
+	# CAT reports the port it opened, keep stdout for the results
+	with contextlib.redirect_stdout(sys.stderr):
+		cat = CAT(variant, settings)
+	done = threading.Event()
+	stamp = [0.0]
+	def callback(response):
+		stamp[0] = perf_counter()
+		done.set()
+	cat.set_callback(callback)
+	# Every get must go to the radio to be timed
+	cat.set_state_ttl(0)
+	cat.start_thrd()
+	results = {}
+	try:
+		for cat_cmd, param in LOOPBACK_COMMANDS:
+			latencies = []
+			failed = 0
+			for i in range(samples):
+				if cat_cmd == CAT_FREQ_SET:
+					# Different every time so nothing can short cut the set
+					param = 7.0 + (i % 1000) * 0.001
+				done.clear()
+				start = perf_counter()
+				future = cat.do_command(cat_cmd, param)
+				if not done.wait(5.0):
+					failed += 1
+					continue
+				r, value = future.result()
+				if not r:
+					failed += 1
+				latencies.append(stamp[0] - start)
+			results[cat_cmd] = percentiles(latencies)
+			results[cat_cmd]['failed'] = failed
+	finally:
+		cat.terminate()
+		rig.terminate()
+	return results
+
+def revision():
+	""" Return the git revision of this file or None """
+
+	try:
+		out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL)
+		return out.decode().strip()
+	except Exception:
+		return None
+
+def run(iterations = ITERATIONS, samples = SAMPLES, baud = BAUD, loopback = True):
+	"""
+	Run the benchmarks and return the results as a dict
+
+	Arguments:
+		iterations	--	calls per codec measurement
+		samples		--	commands per loopback measurement
+		baud		--	serial baud rate for the loopback
+		loopback	--	False to only run the codec benchmarks
+
+	"""
+
+	results = {
+		'revision': revision(),
+		'time': time(),
+		'python': platform.python_version(),
+		'implementation': platform.python_implementation(),
+		'machine': platform.machine(),
+		'codec': bench_codec(iterations),
+	}
+	if loopback:
+		results['loopback'] = {'baud': baud}
+		for variant in CAT_COMMAND_SETS:
+			results['loopback'][variant] = {}
+			for transport in (CAT_SERIAL, CAT_UDP):
+				results['loopback'][variant][transport] = bench_loopback(variant, transport, samples, baud)
+	return results
+
+#======================================================================================================================
+# Entry point
+
+def main():
+
+	try:
+		parser = argparse.ArgumentParser(description = 'CAT benchmarks')
+		parser.add_argument('-o', '--output', help = 'write the JSON here instead of stdout')
+		parser.add_argument('-n', '--iterations', type = int, default = ITERATIONS, help = 'calls per codec measurement')
+		parser.add_argument('-s', '--samples', type = int, default = SAMPLES, help = 'commands per loopback measurement')
+		parser.add_argument('-b', '--baud', type = int, default = BAUD, help = 'serial baud rate for the loopback')
+		parser.add_argument('--codec-only', action = 'store_true', help = 'skip the loopback measurements')
+		args = parser.parse_args()
+
+		results = run(args.iterations, args.samples, args.baud, not args.codec_only)
+		text = json.dumps(results, indent = 2, sort_keys = True)
+		if args.output != None:
+			with open(args.output, 'w') as f:
+				f.write(text + '\n')
+		else:
+			print (text)
+
+	except Exception as e:
+		print ('Exception','Exception [%s][%s]' % (str(e), traceback.format_exc()))
+
+if __name__ == '__main__':
+	main()
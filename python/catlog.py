@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+#
+# catlog.py
+#
+# Record and replay of CAT wire traffic
+#
+# Copyright (C) 2015 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os, sys
+import mmap
+import struct
+import threading
+import argparse
+from time import sleep, time, perf_counter
+import traceback
+
+# Application imports
+from commondefs import *
+from civ import *
+
+"""
+
+A log is an append only file of frames as they went over the wire.
+
+	File header		--	magic and format version, 8 bytes
+	Record header	--	little endian
+						double	wall clock time the frame was sent or received
+						byte	LOG_TX | LOG_RX
+						byte	index into CAT_VARIANTS
+						byte	index into LOG_COMMANDS, 0 if not known (unsolicited)
+						byte	reserved
+						ushort	length of the frame
+	Frame			--	the bytes
+
+Give a CATRecorder to CAT.set_recorder() to capture traffic. CATLog reads
+a log through mmap, records are returned as memoryviews into the mapping
+so only the pages in use are read and nothing is copied. A log can be
+replayed through the YAESU and ICOM decoders with decode() or written out
+to a port, usually one side of a virtual port pair (see vdev.py), with
+replay() at the original timing or faster.
+
+Run as:
+	python catlog.py decode <log> [-v]
+	python catlog.py replay <log> <port> [--direction tx|rx] [--speed n]
+
+"""
+
+MAGIC = b'CATLOG\x01\x00'
+RECORD = struct.Struct('<dBBBxH')
+
+# Command types by index, 0 is for frames not sent in answer to a command
+LOG_COMMANDS = (None, CAT_LOCK, CAT_PTT, CAT_FREQ_SET, CAT_MODE_SET, CAT_FREQ_GET, CAT_MODE_GET, CAT_FREQ_MODE_GET)
+LOG_COMMAND_INDEX = {cat_cmd: index for index, cat_cmd in enumerate(LOG_COMMANDS)}
+
+"""
+
+Writes a log
+
+"""
+class CATRecorder:
+
+	def __init__(self, path):
+		"""
+		Constructor
+
+		Arguments:
+			path	--	log file, appended to if it exists
+
+		"""
+
+		self.__lock = threading.Lock()
+		self.__f = open(path, 'ab')
+		if self.__f.tell() == 0:
+			self.__f.write(MAGIC)
+
+	def record(self, direction, variant, cat_cmd, data):
+		"""
+		Append a frame
+
+		Arguments:
+			direction	--	LOG_TX | LOG_RX
+			variant		--	CAT variant
+			cat_cmd		--	command type the frame belongs to or None
+			data		--	the frame
+
+		"""
+
+		header = RECORD.pack(time(), direction, CAT_VARIANTS.index(variant), LOG_COMMAND_INDEX.get(cat_cmd, 0), len(data))
+		with self.__lock:
+			if self.__f != None:
+				self.__f.write(header)
+				self.__f.write(data)
+
+	def flush(self):
+		""" Write out anything buffered """
+
+		with self.__lock:
+			if self.__f != None:
+				self.__f.flush()
+
+	def close(self):
+		""" Close the log """
+
+		with self.__lock:
+			if self.__f != None:
+				self.__f.close()
+				self.__f = None
+
+"""
+
+Reads a log
+
+"""
+class CATLog:
+
+	def __init__(self, path):
+		"""
+		Constructor
+
+		Arguments:
+			path	--	log file
+
+		Raises ValueError if the file is not a log.
+
+		"""
+
+		self.__map = None
+		self.__view = None
+		self.__f = open(path, 'rb')
+		size = os.fstat(self.__f.fileno()).st_size
+		if size < len(MAGIC):
+			self.__f.close()
+			raise ValueError('%s is not a CAT log' % path)
+		self.__map = mmap.mmap(self.__f.fileno(), 0, access = mmap.ACCESS_READ)
+		if self.__map[:len(MAGIC)] != MAGIC:
+			self.close()
+			raise ValueError('%s is not a CAT log' % path)
+		self.__view = memoryview(self.__map)
+
+	def __iter__(self):
+		"""
+		Generator for (time, direction, variant, cat_cmd, frame)
+
+		The frame is a memoryview into the log, copy it to keep it.
+		A record cut short by a crash ends the log.
+
+		"""
+
+		view = self.__view
+		size = len(view)
+		offset = len(MAGIC)
+		unpack = RECORD.unpack_from
+		header = RECORD.size
+		while offset + header <= size:
+			t, direction, variant, cat_cmd, n = unpack(view, offset)
+			offset += header
+			if offset + n > size:
+				return
+			yield t, direction, CAT_VARIANTS[variant], LOG_COMMANDS[cat_cmd], view[offset:offset + n]
+			offset += n
+
+	def close(self):
+		""" Release the mapping, no frames may be held """
+
+		if self.__view != None:
+			self.__view.release()
+			self.__view = None
+		if self.__map != None:
+			self.__map.close()
+			self.__map = None
+		self.__f.close()
+
+def decode(log, callback = None):
+	"""
+	Pass every received frame through the decoder for its variant
+
+	Arguments:
+		log			--	a CATLog
+		callback	--	called with (time, variant, cat_cmd, response) for each decoded frame
+
+	Returns {'frames': n, 'decoded': n, 'unsolicited': n, 'failed': n}
+
+	Responses are decoded with decode_cat_resp(), answers to sets with
+	ack_nak() and CI-V frames that were not an answer with decode_transceive().
+
+	"""
+
+	# Imported here so cat.py can import this module
+	from cat import CAT_COMMAND_SETS
+
+	instances = {}
+	counts = {'frames': 0, 'decoded': 0, 'unsolicited': 0, 'failed': 0}
+	for t, direction, variant, cat_cmd, frame in log:
+		counts['frames'] += 1
+		if direction != LOG_RX:
+			continue
+		inst = instances.get(variant)
+		if inst == None:
+			command_set = CAT_COMMAND_SETS[variant]
+			inst = instances[variant] = (command_set[CLASS](command_set), command_set)
+		try:
+			if cat_cmd == None:
+				if not hasattr(inst[0], 'decode_transceive') or len(frame) < MIN_FRAME:
+					continue
+				response = inst[0].decode_transceive(inst[1], frame)
+				counts['unsolicited'] += 1
+			elif inst[0].is_response(cat_cmd):
+				response = inst[0].decode_cat_resp(inst[1], cat_cmd, frame)
+				counts['decoded'] += 1
+			else:
+				response = inst[0].ack_nak(inst[1], frame)
+				counts['decoded'] += 1
+		except Exception:
+			counts['failed'] += 1
+			continue
+		if callback != None:
+			callback(t, variant, cat_cmd, response)
+	return counts
+
+def replay(log, port, direction = LOG_RX, speed = 1.0):
+	"""
+	Write the frames sent in one direction out to a port
+
+	Arguments:
+		log			--	a CATLog
+		port		--	a tty, usually one end of a virtual port pair
+		direction	--	LOG_RX to play the radio, LOG_TX to play the controller
+		speed		--	1.0 for the original timing, 10.0 for ten times as fast,
+						0 for as fast as possible
+
+	Returns the number of frames written.
+
+	"""
+
+	# Unix only, imported here so the rest of the module loads anywhere
+	import tty
+
+	fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+	try:
+		tty.setraw(fd)
+		n = 0
+		first = None
+		start = perf_counter()
+		for t, d, variant, cat_cmd, frame in log:
+			if d != direction:
+				continue
+			if first == None:
+				first = t
+			if speed > 0:
+				wait = start + (t - first) / speed - perf_counter()
+				if wait > 0:
+					sleep(wait)
+			os.write(fd, frame)
+			n += 1
+		return n
+	finally:
+		os.close(fd)
+
+#======================================================================================================================
+# Entry point
+
+def main():
+
+	try:
+		parser = argparse.ArgumentParser(description = 'CAT log tools')
+		sub = parser.add_subparsers(dest = 'tool')
+		p = sub.add_parser('decode', help = 'decode the received frames')
+		p.add_argument('log')
+		p.add_argument('-v', '--verbose', action = 'store_true', help = 'print every response')
+		p = sub.add_parser('replay', help = 'write frames out to a port')
+		p.add_argument('log')
+		p.add_argument('port')
+		p.add_argument('--direction', choices = ('tx', 'rx'), default = 'rx', help = 'rx to play the radio, tx to play the controller')
+		p.add_argument('--speed', type = float, default = 1.0, help = 'timing multiplier, 0 for as fast as possible')
+		args = parser.parse_args()
+
+		log = CATLog(args.log)
+		start = perf_counter()
+		if args.tool == 'decode':
+			callback = None
+			if args.verbose:
+				callback = lambda t, variant, cat_cmd, response: print ('%.6f %s %s %s' % (t, variant, cat_cmd, response))
+			counts = decode(log, callback)
+			print ('%s in %.3fs' % (counts, perf_counter() - start))
+		elif args.tool == 'replay':
+			n = replay(log, args.port, LOG_RX if args.direction == 'rx' else LOG_TX, args.speed)
+			print ('%d frames in %.3fs' % (n, perf_counter() - start))
+		else:
+			parser.print_help()
+		log.close()
+
+	except Exception as e:
+		print ('Exception','Exception [%s][%s]' % (str(e), traceback.format_exc()))
+
+if __name__ == '__main__':
+	main()
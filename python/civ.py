@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#
+# civ.py
+#
+# CI-V stream framing for the ICOM CAT variant
+#
+# Copyright (C) 2015 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import threading
+
+"""
+
+A CI-V frame is:
+
+	FE FE | to | from | Cn | [Sc] | [DataArea] | FD
+
+The bus is a single wire so everything we send comes back to us. The
+radio may also send unsolicited frames, for example when CI-V Transceive is
+on and the VFO moves, and there may be noise on the line when the radio is
+switched on or off.
+
+The framer accumulates whatever bytes are available and returns complete
+frames. It drops our own echoed frames, skips anything that is not inside
+a FE FE ... FD frame and copes with any number of frames in one read.
+Frames are views into the framer's buffer so nothing is allocated per frame.
+
+"""
+
+# CI-V framing bytes
+PREAMBLE = 0xFE
+EOM = 0xFD
+# Default controller address
+CONTROLLER = 0xE0
+# Default IC7100 address
+RIG = 0x88
+# Transceive frames are sent to everyone
+BROADCAST = 0x00
+
+# Offsets into a frame
+TO_ADDR = 2
+FROM_ADDR = 3
+CMD = 4
+# Preamble, to, from, command, EOM
+MIN_FRAME = 6
+
+def build_frame(body, to = RIG, frm = CONTROLLER):
+	"""
+	Return a complete frame as bytes
+
+	Arguments:
+		body	--	command, sub-command and data area
+		to		--	address of the receiver
+		frm		--	address of the sender
+
+	"""
+
+	return bytes([PREAMBLE, PREAMBLE, to, frm]) + bytes(body) + bytes([EOM])
+
+"""
+
+CI-V stream framer
+
+"""
+class CIVFramer:
+
+	def __init__(self, controller = CONTROLLER, size = 256):
+		"""
+		Constructor
+
+		Arguments:
+			controller	--	our CI-V address, frames from this address are echoes
+			size		--	receive buffer size, must hold at least one frame
+
+		"""
+
+		self.__controller = controller
+		self.__size = size
+		self.__buf = bytearray(size)
+		self.__view = memoryview(self.__buf)
+		# Unconsumed data is self.__buf[self.__start:self.__end]
+		self.__start = 0
+		self.__end = 0
+
+	def reset(self):
+		""" Discard any buffered data """
+
+		self.__start = 0
+		self.__end = 0
+
+	def feed(self, data):
+		"""
+		Add received bytes to the buffer
+
+		Arguments:
+			data	--	the bytes received
+
+		"""
+
+		n = len(data)
+		if n == 0:
+			return
+		if self.__end + n > self.__size:
+			# Move what we have down to the start of the buffer
+			pending = self.__end - self.__start
+			if pending + n > self.__size:
+				# No room, anything we have can't be a valid frame
+				pending = 0
+				if n > self.__size:
+					data = data[n - self.__size:]
+					n = self.__size
+			self.__view[0:pending] = self.__view[self.__end - pending:self.__end]
+			self.__start = 0
+			self.__end = pending
+		self.__view[self.__end:self.__end + n] = data
+		self.__end += n
+
+	def frames(self):
+		"""
+		Generator for the complete frames in the buffer
+
+		Each frame is returned as a memoryview with exactly two preamble bytes.
+		It is only valid until the next feed(), copy it to keep it.
+		A partial frame is left in the buffer for the next read.
+
+		"""
+
+		buf = self.__buf
+		while True:
+			end = self.__end
+			s = buf.find(b'\xfe\xfe', self.__start, end)
+			if s < 0:
+				# No preamble, discard all but a trailing 0xFE which may start one
+				if end > self.__start and buf[end - 1] == PREAMBLE:
+					self.__start = end - 1
+				else:
+					self.__start = self.__end = 0
+				return
+			# Some radios send more than two preamble bytes
+			p = s + 2
+			while p < end and buf[p] == PREAMBLE:
+				p += 1
+			e = buf.find(EOM, p, end)
+			# A new preamble ahead of the EOM means the frame was truncated
+			n = buf.find(b'\xfe\xfe', p, end if e < 0 else e)
+			if n >= 0:
+				self.__start = n
+				continue
+			if e < 0:
+				# Incomplete, wait for the rest
+				self.__start = p - 2
+				return
+			self.__start = e + 1
+			if e + 1 - (p - 2) < MIN_FRAME:
+				# Not a valid frame
+				continue
+			if buf[p + 1] == self.__controller:
+				# Our own command echoed back
+				continue
+			yield self.__view[p - 2:e + 1]
+
+"""
+
+Serial reader for a CI-V link
+
+"""
+class CIVReader (threading.Thread):
+
+	"""
+	Reads everything that arrives on the link into a framer so that
+	unsolicited frames are seen even when no command is outstanding.
+	The framer is only touched with the condition held and the condition
+	is notified whenever new data is added.
+
+	"""
+
+	def __init__(self, device, framer, cond):
+		"""
+		Constructor
+
+		Arguments:
+			device	--	an open serial device
+			framer	--	the CIVFramer to feed
+			cond	--	the threading.Condition protecting the framer
+
+		"""
+
+		super(CIVReader, self).__init__()
+
+		self.__device = device
+		self.__framer = framer
+		self.__cond = cond
+		self.__terminate = False
+
+	def terminate(self):
+		""" Asked to terminate the thread """
+
+		self.__terminate = True
+		# Release a blocked read if the device supports it
+		cancel_read = getattr(self.__device, 'cancel_read', None)
+		if cancel_read != None:
+			cancel_read()
+
+	def run(self):
+		""" Thread entry point """
+
+		while not self.__terminate:
+			try:
+				n = self.__device.in_waiting
+				# If nothing is waiting we block for one byte using the device timeout
+				data = self.__device.read(n if n > 0 else 1)
+			except Exception as e:
+				# Port closed or device gone
+				break
+			if len(data) > 0:
+				with self.__cond:
+					self.__framer.feed(data)
+					self.__cond.notify()
@@ -81,6 +81,7 @@ PARITY = 'parity'
 STOP_BITS = 'stopbits'
 TIMEOUT = 'timeout'
 READ_SZ = 'readsz'
+GAP = 'gap'
 LOCK_CMD = 'lockcmd'
 LOCK_SUB = 'locksub'
 LOCK_ON = 'lockon'
@@ -105,6 +106,14 @@ RESPONSES = 'responses'
 ACK = 'ack'
 NAK = 'nak'
 
+# Serial line settings used in command sets.
+# The values are the ones pyserial uses so they can be passed straight through.
+PARITY_NONE = 'N'
+PARITY_EVEN = 'E'
+PARITY_ODD = 'O'
+STOPBITS_ONE = 1
+STOPBITS_TWO = 2
+
 # ============================================================================
 # Constants used in command sets and to be used by callers for mode changes
 MODE_LSB = 'lsb'
@@ -128,6 +137,18 @@ CAT_FREQ_SET = 'catfreqset'
 CAT_MODE_SET = 'catmodeset'
 CAT_FREQ_GET = 'catfreqget'
 CAT_MODE_GET = 'catmodeget'
+# Frequency and mode in one exchange where the radio supports it (FT-817)
+CAT_FREQ_MODE_GET = 'catfreqmodeget'
+
+# ============================================================================
+# Unsolicited changes reported to CAT subscribers
+CAT_EVT_FREQ = 'catevtfreq'
+CAT_EVT_MODE = 'catevtmode'
+
+# ============================================================================
+# Direction of a frame in a CAT log (catlog.py)
+LOG_TX = 0
+LOG_RX = 1
 
 # ============================================================================
 # Loop actuator definitions
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+#
+# rigemu.py
+#
+# FT-817ND and IC7100 CAT emulator for testing without a radio
+#
+# Copyright (C) 2015 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os, sys
+import tty
+import socket
+import select
+import threading
+import heapq
+import random
+from time import sleep, monotonic
+import traceback
+
+# Application imports
+from commondefs import *
+from civ import *
+from cat import CAT_COMMAND_SETS, COMPILED_COMMAND_SETS, ICOMCommandSet, char_time
+import bcd
+
+"""
+
+Emulates the part of the FT-817ND and IC7100 CAT protocols that the YAESU
+and ICOM classes use: frequency and mode set and get, PTT and lock, and for
+CI-V the OK/NG responses and transceive frames. The command bytes come
+from CAT_COMMAND_SETS so the emulator follows any change to them.
+
+The radio is presented on a pseudo terminal, give get_port() to CAT as the
+COM port, or on a local UDP port. Each emulator runs one thread.
+
+To make it behave more like a real link:
+	latency		--	seconds between receiving a command and starting the response
+	baud		--	both directions take the wire time for the bytes at this rate
+	drop_rate	--	fraction of commands ignored as if lost on the line
+	echo		--	send every command back, as the single wire CI-V bus does
+
+Responses are scheduled rather than slept for so a UDP client can have
+several requests outstanding.
+
+"""
+
+# Frequency and mode at power on
+DEFAULT_FREQ = 14074000
+DEFAULT_MODE = MODE_USB
+
+# Extra CI-V commands accepted for set frequency and set mode
+CIV_SET_FREQ = 0x05
+CIV_SET_MODE = 0x06
+# Filter byte returned with the mode
+CIV_FILTER = 0x01
+
+class RigEmulator (threading.Thread):
+
+	def __init__(self, variant, transport = CAT_SERIAL, port = 0, latency = 0.0, baud = None, drop_rate = 0.0, echo = None, transceive = False, seed = None):
+		"""
+		Constructor
+
+		Arguments:
+			variant		--	FT_817ND | IC7100
+			transport	--	CAT_SERIAL for a pseudo terminal | CAT_UDP
+			port		--	UDP port, 0 to pick a free one
+			latency		--	response latency in seconds
+			baud		--	baud rate to shape the traffic to, None for no shaping
+			drop_rate	--	0.0 to 1.0, fraction of commands to ignore
+			echo		--	True to echo commands, None for the radio default
+			transceive	--	ICOM, True to send frequency and mode changes made by tune()
+			seed		--	random seed for repeatable drops
+
+		"""
+
+		super(RigEmulator, self).__init__()
+
+		if variant not in CAT_COMMAND_SETS:
+			raise LookupError
+		self.__variant = variant
+		self.__command_set = CAT_COMMAND_SETS[variant]
+		self.__cs = COMPILED_COMMAND_SETS[variant]
+		self.__icom = isinstance(self.__cs, ICOMCommandSet)
+		self.__transport = transport
+		self.__latency = latency
+		self.__char_time = 0.0
+		if baud != None:
+			self.__char_time = char_time(baud, self.__command_set[SERIAL][PARITY], self.__command_set[SERIAL][STOP_BITS])
+		self.__drop_rate = drop_rate
+		# CI-V on a serial line always echoes
+		self.__echo = echo if echo != None else (self.__icom and transport == CAT_SERIAL)
+		self.__transceive = transceive
+		self.__random = random.Random(seed)
+
+		# Radio state
+		self.__lock = threading.Lock()
+		self.__freq = DEFAULT_FREQ
+		self.__mode = DEFAULT_MODE
+		self.__ptt = False
+		self.__locked = False
+		self.__counts = {'commands': 0, 'dropped': 0, 'unknown': 0, 'naks': 0}
+
+		# Pending output, a heap of (due, sequence, data, address)
+		self.__out = []
+		self.__seq = 0
+		# When each direction of the line is next free
+		self.__rx_free = 0.0
+		self.__tx_free = 0.0
+
+		# Open the link
+		self.__master = None
+		self.__slave = None
+		self.__sock = None
+		if transport == CAT_SERIAL:
+			self.__master, self.__slave = os.openpty()
+			tty.setraw(self.__master)
+			tty.setraw(self.__slave)
+			os.set_blocking(self.__master, False)
+			self.__port = os.ttyname(self.__slave)
+		else:
+			self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			self.__sock.bind(('127.0.0.1', port))
+			self.__sock.setblocking(False)
+			self.__port = self.__sock.getsockname()
+		# Last UDP client, transceive frames go to it
+		self.__peer = None
+		self.__rx = bytearray()
+		self.__framer = CIVFramer(controller = RIG)
+		# Written to by terminate() and tune() to release select()
+		self.__wake_r, self.__wake_w = socket.socketpair()
+		self.__terminate = False
+
+	def get_port(self):
+		""" Return the pseudo terminal name or the UDP (ip, port) """
+
+		return self.__port
+
+	def get_state(self):
+		""" Return the radio state as a dict """
+
+		with self.__lock:
+			return {CAT_FREQ_GET: self.__freq, CAT_MODE_GET: self.__mode, CAT_PTT: self.__ptt, CAT_LOCK: self.__locked}
+
+	def get_counts(self):
+		""" Return the command counters as a dict """
+
+		with self.__lock:
+			return dict(self.__counts)
+
+	def tune(self, freq = None, mode = None):
+		"""
+		Change the radio as if from the front panel
+
+		Arguments:
+			freq	--	new frequency in Hz or None
+			mode	--	new mode or None
+
+		With transceive on an ICOM radio reports the change.
+
+		"""
+
+		with self.__lock:
+			if freq != None:
+				self.__freq = freq
+			if mode != None:
+				self.__mode = mode
+			if self.__icom and self.__transceive:
+				now = monotonic()
+				if freq != None:
+					self.__send(now, build_frame(bytes([self.__cs.freq_cmd]) + bcd.encode_le(freq, 5), to = BROADCAST, frm = RIG), self.__peer)
+				if mode != None:
+					self.__send(now, build_frame(bytes([self.__cs.mode_cmd]) + self.__cs.mode_codes[mode] + bytes([CIV_FILTER]), to = BROADCAST, frm = RIG), self.__peer)
+		self.__wake_w.send(b'\x00')
+
+	def terminate(self):
+		""" Asked to terminate the thread """
+
+		self.__terminate = True
+		self.__wake_w.send(b'\x00')
+		self.join()
+		if self.__master != None:
+			os.close(self.__master)
+			os.close(self.__slave)
+		if self.__sock != None:
+			self.__sock.close()
+		self.__wake_r.close()
+		self.__wake_w.close()
+
+	def run(self):
+		""" Thread entry point """
+
+		link = self.__master if self.__master != None else self.__sock
+		while not self.__terminate:
+			try:
+				# Wait for input or the next response to become due
+				with self.__lock:
+					timeout = None
+					if len(self.__out) > 0:
+						timeout = max(0.0, self.__out[0][0] - monotonic())
+				r, w, x = select.select([link, self.__wake_r], [], [], timeout)
+				if self.__wake_r in r:
+					self.__wake_r.recv(64)
+				if link in r:
+					self.__receive()
+				self.__transmit()
+			except Exception as e:
+				print ('Exception in RigEmulator [%s][%s]' % (str(e), traceback.format_exc()))
+
+	def __receive(self):
+		""" Read what has arrived and process complete commands """
+
+		now = monotonic()
+		if self.__master != None:
+			try:
+				data = os.read(self.__master, 4096)
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError:
+				# Nothing has the slave side open yet
+				sleep(0.01)
+				return
+			addr = None
+		else:
+			try:
+				data, addr = self.__sock.recvfrom(4096)
+			except (BlockingIOError, InterruptedError, ConnectionRefusedError):
+				return
+			self.__peer = addr
+		with self.__lock:
+			if self.__icom:
+				self.__framer.feed(data)
+				for frame in self.__framer.frames():
+					self.__command(now, bytes(frame), addr)
+			else:
+				if addr != None:
+					# A datagram is a command, nothing carries over
+					self.__rx = bytearray()
+				self.__rx += data
+				while len(self.__rx) >= 5:
+					cmd = bytes(self.__rx[:5])
+					del self.__rx[:5]
+					self.__command(now, cmd, addr)
+
+	def __transmit(self):
+		""" Send everything that is due """
+
+		while True:
+			with self.__lock:
+				if len(self.__out) == 0 or self.__out[0][0] > monotonic():
+					return
+				due, seq, data, addr = heapq.heappop(self.__out)
+			if self.__master != None:
+				os.write(self.__master, data)
+			else:
+				self.__sock.sendto(data, addr)
+
+	def __send(self, ready, data, addr):
+		"""
+		Schedule output, call with the lock held
+
+		Arguments:
+			ready	--	time the radio starts to send
+			data	--	the bytes
+			addr	--	UDP address or None
+
+		"""
+
+		start = max(ready, self.__tx_free)
+		self.__tx_free = start + len(data) * self.__char_time
+		self.__seq += 1
+		heapq.heappush(self.__out, (self.__tx_free, self.__seq, data, addr))
+
+	def __command(self, now, cmd, addr):
+		"""
+		Execute one command and schedule the response, call with the lock held
+
+		Arguments:
+			now		--	time the data was read
+			cmd		--	the command bytes, a whole CI-V frame for ICOM
+			addr	--	UDP address to reply to or None
+
+		"""
+
+		# The command is complete when its last byte is off the wire
+		self.__rx_free = max(now, self.__rx_free) + len(cmd) * self.__char_time
+		self.__counts['commands'] += 1
+		if self.__echo:
+			self.__send(self.__rx_free, cmd, addr)
+		if self.__drop_rate > 0.0 and self.__random.random() < self.__drop_rate:
+			self.__counts['dropped'] += 1
+			return
+		if self.__icom:
+			response = self.__civ_command(cmd)
+		else:
+			response = self.__yaesu_command(cmd)
+		if response != None:
+			self.__send(self.__rx_free + self.__latency, response, addr)
+
+	def __yaesu_command(self, cmd):
+		"""
+		Execute an FT-817 command
+
+		Arguments:
+			cmd	--	4 parameter bytes and the command byte
+
+		Returns the response bytes or None
+
+		"""
+
+		commands = self.__command_set[COMMANDS]
+		op = cmd[4]
+		if op == commands[FREQ_MODE_GET]:
+			return bcd.encode_be(self.__freq // 10, 4) + bytes([self.__cs.mode_codes[self.__mode]])
+		elif op == commands[SET_FREQ]:
+			self.__freq = bcd.decode_be(cmd, 0, 4) * 10
+		elif op == commands[SET_MODE]:
+			if cmd[0] in self.__cs.mode_names:
+				self.__mode = self.__cs.mode_names[cmd[0]]
+		elif op == commands[LOCK_ON] or op == commands[LOCK_OFF]:
+			self.__locked = op == commands[LOCK_ON]
+		elif op == commands[PTT_ON] or op == commands[PTT_OFF]:
+			self.__ptt = op == commands[PTT_ON]
+		else:
+			self.__counts['unknown'] += 1
+		# Sets are not answered
+		return None
+
+	def __civ_command(self, frame):
+		"""
+		Execute a CI-V command
+
+		Arguments:
+			frame	--	the complete frame
+
+		Returns the response frame or None
+
+		"""
+
+		if frame[TO_ADDR] != RIG:
+			# Not for us
+			return None
+		commands = self.__command_set[COMMANDS]
+		body = frame[CMD:-1]
+		lock = bytes(commands[LOCK_CMD] + commands[LOCK_SUB])
+		ptt = bytes(commands[TRANCEIVE_STATUS_CMD] + commands[TRANCEIVE_STATUS_SUB])
+		reply = None
+		ok = False
+		try:
+			if body == bytes(commands[GET_FREQ_CMD] + commands[GET_FREQ_SUB]):
+				reply = body + bcd.encode_le(self.__freq, 5)
+			elif body == bytes(commands[GET_MODE_CMD] + commands[GET_MODE_SUB]):
+				reply = body + self.__cs.mode_codes[self.__mode] + bytes([CIV_FILTER])
+			elif body[0] in (self.__cs.freq_cmd, CIV_SET_FREQ) and len(body) == 6:
+				self.__freq = bcd.decode_le(body, 1, 5)
+				ok = True
+			elif body[0] in (self.__cs.mode_cmd, CIV_SET_MODE) and len(body) in (2, 3):
+				if body[1] in self.__cs.mode_names:
+					self.__mode = self.__cs.mode_names[body[1]]
+					ok = True
+			elif body.startswith(lock):
+				if len(body) == len(lock):
+					reply = body + bytes([1 if self.__locked else 0])
+				else:
+					self.__locked = body[len(lock)] != 0
+					ok = True
+			elif body.startswith(ptt):
+				if len(body) == len(ptt):
+					reply = body + bytes([1 if self.__ptt else 0])
+				else:
+					self.__ptt = body[len(ptt)] != 0
+					ok = True
+			else:
+				self.__counts['unknown'] += 1
+		except ValueError:
+			# Bad BCD
+			ok = False
+		if reply == None:
+			if not ok:
+				self.__counts['naks'] += 1
+			reply = bytes([self.__cs.ack if ok else self.__cs.nak])
+		return build_frame(reply, to = frame[FROM_ADDR], frm = RIG)
+
+#======================================================================================================================
+# Testing code
+
+def main():
+
+	"""
+	Run an emulator until interrupted
+
+		python rigemu.py [FT-817ND | IC7100] [serial | udp] [latency] [baud]
+
+	"""
+
+	try:
+		variant = sys.argv[1] if len(sys.argv) > 1 else FT_817ND
+		transport = CAT_UDP if len(sys.argv) > 2 and sys.argv[2] == 'udp' else CAT_SERIAL
+		latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+		baud = int(sys.argv[4]) if len(sys.argv) > 4 else None
+		rig = RigEmulator(variant, transport, latency = latency, baud = baud)
+		rig.start()
+		print ('%s emulator on %s' % (variant, rig.get_port()))
+		try:
+			while True:
+				sleep(5.0)
+				print (rig.get_state(), rig.get_counts())
+		except KeyboardInterrupt:
+			pass
+		rig.terminate()
+
+	except Exception as e:
+		print ('Exception','Exception [%s][%s]' % (str(e), traceback.format_exc()))
+
+# Entry point
+if __name__ == '__main__':
+	main()
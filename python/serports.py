@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# serports.py
+#
+# Serial port enumeration
+#
+# Copyright (C) 2015 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+# System imports
+import os, sys
+import glob
+import threading
+
+"""
+
+Lists the serial ports on the machine.
+
+On Linux every tty with real hardware behind it has a device link under
+/sys/class/tty so the list is built without opening anything. Opening
+ports to test them is slow, some drivers block on open, and a port can't
+be listed once we have it open. Platform UARTs (ttyS*) are registered
+whether or not the hardware exists so they are left out, as pyserial does.
+
+Other platforms still have to open each candidate port to test it.
+
+The result is cached and get() always returns immediately. The first
+call, and any call after /dev has changed (a device was plugged in or
+removed), starts a background scan. On Linux the scan only looks at
+ttys it has not seen before.
+
+"""
+
+SYS_TTY = '/sys/class/tty'
+
+class SerialPorts:
+
+	def __init__(self):
+		"""
+		Constructor
+
+		"""
+
+		self.__lock = threading.Lock()
+		self.__ports = []
+		# tty name -> True if it is a serial port
+		self.__known = {}
+		# /dev modification time at the last scan
+		self.__dev_mtime = None
+		self.__scan_thrd = None
+
+	def get(self, wait = False):
+		"""
+		Return available serial port names
+
+		Arguments:
+			wait	--	True to wait for any scan to complete
+
+		"""
+
+		if self.__changed():
+			self.refresh(wait)
+		elif wait:
+			self.__wait()
+		with self.__lock:
+			return list(self.__ports)
+
+	def refresh(self, wait = False):
+		"""
+		Start a scan unless one is running
+
+		Arguments:
+			wait	--	True to wait for the scan to complete
+
+		"""
+
+		with self.__lock:
+			if self.__scan_thrd == None or not self.__scan_thrd.is_alive():
+				self.__scan_thrd = threading.Thread(target=self.__scan)
+				self.__scan_thrd.daemon = True
+				self.__scan_thrd.start()
+		if wait:
+			self.__wait()
+
+	def __wait(self):
+		""" Wait for a running scan """
+
+		thrd = self.__scan_thrd
+		if thrd != None:
+			thrd.join()
+
+	def __changed(self):
+		""" True if there has been no scan or /dev has changed since the last one """
+
+		return self.__dev_mtime == None or self.__stat_dev() != self.__dev_mtime
+
+	def __stat_dev(self):
+		""" Return the /dev modification time, 0 where there is no /dev (Windows) """
+
+		try:
+			return os.stat('/dev').st_mtime_ns
+		except OSError:
+			return 0
+
+	def __scan(self):
+		""" Thread entry point, build the port list """
+
+		mtime = self.__stat_dev()
+		if sys.platform.startswith('linux') and os.path.isdir(SYS_TTY):
+			ports = self.__scan_sysfs()
+		else:
+			ports = self.__scan_open()
+		with self.__lock:
+			self.__ports = ports
+			self.__dev_mtime = mtime
+
+	def __scan_sysfs(self):
+		""" List the ports from sysfs, only new ttys are examined """
+
+		known = {}
+		for name in os.listdir(SYS_TTY):
+			if name in self.__known:
+				known[name] = self.__known[name]
+				continue
+			device = os.path.join(SYS_TTY, name, 'device')
+			is_port = os.path.exists(device)
+			if is_port:
+				# Exclude platform UARTs, they exist with or without hardware
+				subsystem = os.path.join(device, 'subsystem')
+				is_port = not (os.path.exists(subsystem) and os.path.basename(os.path.realpath(subsystem)) == 'platform')
+			known[name] = is_port
+		self.__known = known
+		return sorted('/dev/' + name for name, is_port in known.items() if is_port)
+
+	def __scan_open(self):
+		""" List the ports by trying to open each candidate """
+
+		try:
+			import serial
+		except ImportError:
+			# Nothing can be opened, the scan is still complete
+			return []
+
+		all_ports = []
+		if sys.platform.startswith('win'):
+			all_ports = ['COM%s' % (i + 1) for i in range(20)]
+		elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
+			# this excludes your current terminal "/dev/tty"
+			all_ports = glob.glob('/dev/tty[A-Za-z]*')
+		elif sys.platform.startswith('darwin'):
+			all_ports = glob.glob('/dev/tty.*')
+
+		ports = []
+		for port in all_ports:
+			try:
+				s = serial.Serial(port)
+				s.close()
+				ports.append(port)
+			except Exception:
+				pass
+		return ports
+
+# The one list for the process
+SERIAL_PORTS = SerialPorts()